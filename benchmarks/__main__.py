@@ -0,0 +1,107 @@
+"""Render benchmarks for generate_ppt and generate_docx.
+
+Every template is rendered from recorded 4, 8 and 15 slide completions, and the abstract
+from a recorded outline, with images served from local fixtures instead of Bing. Each case
+runs in a fresh process so that its peak RSS is its own; the wall time is the median of
+--repeat runs after a warm-up run.
+
+Results are compared against a baseline saved earlier on the same machine, and the exit
+status is 1 when a case got slower, bigger in memory or bigger on disk than the tolerance:
+
+    python -m benchmarks --save-baseline
+    python -m benchmarks
+    python -m benchmarks --templates Floral "East Asia" --sizes 15 --repeat 10
+"""
+import argparse
+import json
+import platform
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+from benchmarks import fixtures
+from benchmarks.render import ROOT, run_case
+
+TEMPLATES_DIR = ROOT / "bot" / "ai_generator" / "presentation_templates"
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+
+
+def cases(args):
+    for template in args.templates:
+        for slides in args.sizes:
+            yield f"ppt/{template}/{slides}", ("ppt", template, slides)
+    if args.docx:
+        yield "docx/abstract", ("docx", None, None)
+
+
+def compare(name, result, baseline, args):
+    """Returns the regressions of result against the baseline entry as printable strings."""
+    regressions = []
+    for key, tolerance in (("seconds", args.time_tolerance), ("peak_rss", args.memory_tolerance),
+                           ("bytes", args.size_tolerance)):
+        before, after = baseline[key], result[key]
+        if before and after > before * (1 + tolerance):
+            regressions.append(f"{name}: {key} {before:.4g} -> {after:.4g} (+{after / before - 1:.0%})")
+    return regressions
+
+
+def change(result, baseline, key):
+    if baseline is None or not baseline[key]:
+        return ""
+    return f"{result[key] / baseline[key] - 1:+.0%}"
+
+
+def main(args):
+    baseline = {}
+    if not args.save_baseline:
+        if args.baseline.exists():
+            baseline = json.loads(args.baseline.read_text())["cases"]
+        else:
+            print(f"No baseline at {args.baseline}, run with --save-baseline to record one\n")
+
+    results, regressions = {}, []
+    print(f"{'case':<28}{'seconds':>9}{'Δ':>6}{'min':>9}{'peak MiB':>10}{'Δ':>6}{'KiB':>8}{'Δ':>6}")
+    # one process per case, so that ru_maxrss is the peak of that case alone
+    context = get_context("spawn")
+    for name, case in cases(args):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_case, *case, args.repeat).result()
+        results[name] = result
+        before = baseline.get(name)
+        print(f"{name:<28}{result['seconds']:>9.3f}{change(result, before, 'seconds'):>6}"
+              f"{result['min_seconds']:>9.3f}{result['peak_rss'] / 2 ** 20:>10.1f}"
+              f"{change(result, before, 'peak_rss'):>6}{result['bytes'] / 1024:>8.0f}"
+              f"{change(result, before, 'bytes'):>6}")
+        if before is not None:
+            regressions += compare(name, result, before, args)
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps({
+            "python": platform.python_version(),
+            "machine": platform.node(),
+            "cases": results,
+        }, indent=2))
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+    if regressions:
+        print("\nRegressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--templates", nargs="+", default=sorted(path.stem for path in TEMPLATES_DIR.glob("*.pptx")))
+    parser.add_argument("--sizes", nargs="+", type=int, choices=fixtures.SLIDE_COUNTS, default=fixtures.SLIDE_COUNTS)
+    parser.add_argument("--no-docx", dest="docx", action="store_false", help="skip the abstract benchmark")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--time-tolerance", type=float, default=0.15)
+    parser.add_argument("--memory-tolerance", type=float, default=0.10)
+    parser.add_argument("--size-tolerance", type=float, default=0.02)
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,40 @@
+import functools
+import io
+import random
+import zlib
+from pathlib import Path
+
+from PIL import Image
+
+REPLIES_DIR = Path(__file__).resolve().parent / "replies"
+SLIDE_COUNTS = (4, 8, 15)
+
+
+def presentation_reply(slides):
+    """Completion recorded for a presentation of the given number of slides."""
+    return (REPLIES_DIR / f"slides_{slides}.txt").read_text(encoding="utf-8")
+
+
+def abstract_reply():
+    return (REPLIES_DIR / "abstract.txt").read_text(encoding="utf-8")
+
+
+@functools.lru_cache(maxsize=None)
+def image(query, size=(1920, 1080)):
+    """A wallpaper sized JPEG standing in for the Bing result of query.
+
+    Smooth colour noise, seeded by the query, compresses about like a photo, so the decks
+    come out with realistic media sizes while staying the same from run to run.
+    """
+    rng = random.Random(zlib.crc32(query.encode()))
+    small = (size[0] // 16, size[1] // 16)
+    picture = Image.frombytes("RGB", small, rng.randbytes(small[0] * small[1] * 3))
+    picture = picture.resize(size, Image.BICUBIC)
+    buffer = io.BytesIO()
+    picture.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+async def download(query, *args, **kwargs):
+    """Drop-in for downloader.download serving fixture images instead of searching Bing."""
+    return image(query)
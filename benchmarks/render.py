@@ -0,0 +1,50 @@
+import asyncio
+import contextlib
+import gc
+import io
+import os
+import resource
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from benchmarks import fixtures
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def run_case(kind, template, slides, repeat):
+    """Runs in a child process: renders one case repeat times and returns its measurements."""
+    sys.path.insert(0, str(ROOT / "bot"))
+    os.chdir(ROOT)
+    from ai_generator import abstract, presentation
+    from ai_generator.image_scrapper import downloader
+
+    downloader.download = fixtures.download
+
+    async def render():
+        if kind == "ppt":
+            file, _ = await presentation.generate_ppt(fixtures.presentation_reply(slides), template)
+        else:
+            file, _ = await abstract.generate_docx(fixtures.abstract_reply())
+        with file:
+            return file.seek(0, io.SEEK_END)
+
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        size = asyncio.run(render())
+        gc.collect()
+        for _ in range(repeat):
+            started = time.perf_counter()
+            asyncio.run(render())
+            timings.append(time.perf_counter() - started)
+            # python-pptx parts reference each other, free the previous deck before the next run
+            gc.collect()
+    return {
+        "seconds": statistics.median(timings),
+        "min_seconds": min(timings),
+        # kilobytes on Linux
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "bytes": size,
+    }
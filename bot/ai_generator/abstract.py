@@ -1,14 +1,32 @@
+import asyncio
 import io
+import logging
 import re
 
 from docx import Document
 from docx.shared import Inches
 
+import metrics
+import tracing
+
 try:
     from image_scrapper import downloader
 except ImportError:
     from .image_scrapper import downloader
 
+try:
+    import openai_utils
+    import spool
+except ImportError:
+    from . import openai_utils
+    from . import spool
+
+logger = logging.getLogger(__name__)
+
+TAGS_PATTERN = r'\[(.*?)\](.*?)\[/\1\]'
+OUTLINE_MAX_TOKENS = 768
+SECTION_MAX_TOKENS = 1024
+
 
 async def generate_docx_prompt(language, emotion_type, topic):
     message = f"""Create an {language} language very long outline for a {emotion_type} research paper on the topic of {topic} which is as comprehensive as possible. 
@@ -47,12 +65,103 @@ Strictly adhere to the specified format without including any additional informa
     return message
 
 
-async def generate_docx(answer):
+async def generate_docx_outline_prompt(language, emotion_type, topic):
+    message = f"""Create an {language} language outline for a {emotion_type} research paper on the topic of {topic} which is as comprehensive as possible.
+Language of research paper - {language}.
+Only list the Title, the Subtitle and the section Headings, do not write the Content of the sections.
+
+Put this tag before the Title: [TITLE]
+Put this tag after the Title: [/TITLE]
+Put this tag before the Subtitle: [SUBTITLE]
+Put this tag after the Subtitle: [/SUBTITLE]
+Put this tag before the Heading: [HEADING]
+Put this tag after the Heading: [/HEADING]
+Put this tag before the Image: [IMAGE]
+Put this tag after the Image: [/IMAGE]
+
+For instance:
+[TITLE]Mental Health[/TITLE]
+[SUBTITLE]Understanding and Nurturing Your Mind: A Comprehensive Guide to Mental Health[/SUBTITLE]
+[HEADING]Mental Health Definition[/HEADING]
+[IMAGE]Person Meditating[/IMAGE]
+[HEADING]Common Mental Disorders[/HEADING]
+
+Pay meticulous attention to the language of the research paper - {language}.
+Accompany some of the headings with an image described by keywords, such as "Mount Everest Sunset" or "Niagara Falls Rainbow".
+Ensure the Title remains free of any special characters (?, !, ., :, ).
+Strictly adhere to the specified format without including any additional information."""
+
+    return message
+
+
+async def generate_docx_section_prompt(language, emotion_type, topic, headings, heading):
+    outline = "\n".join(f"- {item}" for item in headings)
+    message = f"""You are writing an {language} language {emotion_type} research paper on the topic of {topic}.
+The paper has the following sections:
+{outline}
+
+Write the Content of the section "{heading}" only.
+Language of research paper - {language}.
+Provide in-depth and detailed information, elaborate extensively on the section.
+
+Put this tag before the Content: [CONTENT]
+Put this tag after the Content: [/CONTENT]
+
+Do not repeat the heading and do not write the other sections.
+Strictly adhere to the specified format without including any additional information."""
+
+    return message
+
+
+async def generate_docx_sections(language, emotion_type, topic, max_concurrency=4, deadline=None):
+    """Two-phase generation: a short call returns the outline, then the Content of every
+    Heading is generated with concurrent bounded calls and merged back in outline order.
+    An outline without headings falls back to the single-prompt generation."""
+    outline_prompt = await generate_docx_outline_prompt(language, emotion_type, topic)
+    outline, n_used_tokens = await openai_utils.process_prompt(outline_prompt, max_tokens=OUTLINE_MAX_TOKENS,
+                                                               deadline=deadline)
+    outline_tags = re.findall(TAGS_PATTERN, outline, re.DOTALL)
+    headings = [text.strip() for tag, text in outline_tags if tag == 'HEADING']
+    if not headings:
+        logger.warning(f"The outline of {topic!r} has no headings, generating the abstract in one prompt")
+        prompt = await generate_docx_prompt(language, emotion_type, topic)
+        answer, answer_tokens = await openai_utils.process_prompt(prompt, deadline=deadline)
+        return answer, n_used_tokens + answer_tokens
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def generate_section(heading):
+        async with semaphore:
+            section_prompt = await generate_docx_section_prompt(language, emotion_type, topic, headings, heading)
+            section, section_tokens = await openai_utils.process_prompt(section_prompt, max_tokens=SECTION_MAX_TOKENS,
+                                                                        deadline=deadline)
+        content = re.findall(r'\[CONTENT\](.*?)(?:\[/CONTENT\]|$)', section, re.DOTALL)
+        return (content[0] if content else section).strip(), section_tokens
+
+    tasks = [asyncio.create_task(generate_section(heading)) for heading in headings]
+    try:
+        sections = await asyncio.gather(*tasks)
+    except Exception:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    answer = []
+    sections = iter(sections)
+    for tag, text in outline_tags:
+        answer.append(f"[{tag}]{text}[/{tag}]")
+        if tag == 'HEADING':
+            content, section_tokens = next(sections)
+            answer.append(f"[CONTENT]{content}[/CONTENT]")
+            n_used_tokens += section_tokens
+    return "\n".join(answer), n_used_tokens
+
+
+async def generate_docx(answer, deadline=None):
     doc = Document()
+    image_deadline = deadline.stage("images") if deadline else None
 
     async def split_tags(reply):
-        pattern = r'\[(.*?)\](.*?)\[/\1\]'
-        tags = re.findall(pattern, reply, re.DOTALL)
+        tags = re.findall(TAGS_PATTERN, reply, re.DOTALL)
         return tags
 
     async def parse_response(tags_array):
@@ -71,7 +180,8 @@ async def generate_docx(answer):
                 case('IMAGE'):
                     try:
                         image_data = await downloader.download(item[1], limit=1, adult_filter_off=True, timeout=15,
-                                                               filter="+filterui:aspect-wide+filterui:imagesize-wallpaper+filterui:photo-photo")
+                                                               filter="+filterui:aspect-wide+filterui:imagesize-wallpaper+filterui:photo-photo",
+                                                               deadline=image_deadline)
                         doc.add_picture(io.BytesIO(image_data), width=Inches(6))
                     except Exception:
                         pass
@@ -82,11 +192,10 @@ async def generate_docx(answer):
                 return item[1]
 
     reply_array = await split_tags(answer)
-    await parse_response(reply_array)
-    buffer = io.BytesIO()
-    doc.save(buffer)
-    docx_bytes = buffer.getvalue()
+    with metrics.STAGE_SECONDS.labels("render").time(), tracing.span("render"):
+        await parse_response(reply_array)
+    docx_file = spool.save(doc.save)
     docx_title = f"{await find_title(reply_array)}.docx"
-    print(f"done {docx_title}")
+    logger.info(f"Rendered {docx_title}")
 
-    return docx_bytes, docx_title
+    return docx_file, docx_title
@@ -0,0 +1,177 @@
+"""Decks for a list of topics with shared settings.
+
+Every topic goes through the same stages as a single deck: prompt, completion with its
+image prefetch, and rendering. The stages are pipelined across the batch, a topic is
+rendered while the next ones are still generating, with at most llm_concurrency
+completions and render_concurrency decks under construction at a time.
+"""
+import asyncio
+import csv
+import io
+import logging
+import re
+import shutil
+import zipfile
+
+import config
+import metrics
+import tracing
+
+try:
+    from image_scrapper import downloader
+    from deadline import Deadline
+    import openai_utils
+    import presentation
+    import spool
+    import token_budget
+except ImportError:
+    from .image_scrapper import downloader
+    from .deadline import Deadline
+    from . import openai_utils
+    from . import presentation
+    from . import spool
+    from . import token_budget
+
+logger = logging.getLogger(__name__)
+
+TOPIC_FILE_EXTENSIONS = (".txt", ".csv")
+# header cells of a .csv that are not topics
+CSV_HEADERS = {"topic", "topics", "mavzu", "mavzular", "тема"}
+# Telegram sends at most this many documents in one media group
+MEDIA_GROUP_SIZE = 10
+UNSAFE_FILENAME_CHARACTERS = re.compile(r'[\\/:*?"<>|]')
+
+
+def parse_topics(text, csv_file=False):
+    """Topics from multi-line text or the first column of a .csv, without blanks and repeats."""
+    if csv_file:
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        lines = [row[0] if row else "" for row in csv.reader(io.StringIO(text), dialect)]
+    else:
+        lines = text.splitlines()
+    topics = []
+    for line in lines:
+        topic = " ".join(line.split())
+        if topic and topic not in topics and not (csv_file and topic.lower() in CSV_HEADERS):
+            topics.append(topic)
+    return topics
+
+
+def read_topics(data, filename):
+    """Topics from an uploaded .txt or .csv file."""
+    return parse_topics(data.decode("utf-8-sig", errors="replace"), csv_file=filename.lower().endswith(".csv"))
+
+
+class Job:
+    """One topic of a batch: its prompt, the completion once it is there and, once done, the
+    deck or the error."""
+
+    def __init__(self, topic, prompt, max_tokens, expected_tokens, answer=None, n_used_tokens=0):
+        self.topic = topic
+        self.prompt = prompt
+        self.max_tokens = max_tokens
+        self.expected_tokens = expected_tokens
+        self.answer = answer
+        self.n_used_tokens = n_used_tokens
+        self.file = None
+        self.title = None
+        self.error = None
+
+    def state(self):
+        """What a Job is created again from, without the deck."""
+        return {
+            "topic": self.topic,
+            "prompt": self.prompt,
+            "max_tokens": self.max_tokens,
+            "expected_tokens": self.expected_tokens,
+            "answer": self.answer,
+            "n_used_tokens": self.n_used_tokens,
+        }
+
+
+async def prepare(topics, language, emotion_type, slide_count):
+    """Jobs for the topics whose prompt leaves room for a completion, and the topics that don't."""
+    jobs, too_long = [], []
+    for topic in topics:
+        prompt = await presentation.generate_ppt_prompt(language, emotion_type, slide_count, topic)
+        try:
+            max_tokens = token_budget.fit_max_tokens(prompt, token_budget.presentation_max_tokens(slide_count))
+        except ValueError:
+            too_long.append(topic)
+            continue
+        jobs.append(Job(topic, prompt, max_tokens,
+                        token_budget.expected_presentation_cost(prompt, slide_count)))
+    return jobs, too_long
+
+
+async def generate(jobs, emotion_type, template, llm_concurrency=2, render_concurrency=1, on_answer=None):
+    """Runs the jobs through the pipeline. A failed job keeps its exception in job.error and
+    does not stop the others. Jobs that already have their answer skip the completion,
+    on_answer(job) is called when one gets it."""
+    llm_slots = asyncio.Semaphore(llm_concurrency)
+    render_slots = asyncio.Semaphore(render_concurrency)
+
+    async def run(index, job):
+        speculation = None
+        with tracing.span("deck", index=index):
+            try:
+                if job.answer is None:
+                    async with llm_slots:
+                        # the deadline starts with the job, not while it waits for a slot
+                        deadline = Deadline(config.job_deadline_seconds, config.job_stage_shares)
+                        image_queries = await presentation.speculative_image_queries(emotion_type, job.topic)
+                        speculation = downloader.prefetch(image_queries, timeout=15, filter=presentation.IMAGE_FILTER)
+                        job.answer, job.n_used_tokens = await openai_utils.process_prompt(
+                            job.prompt, max_tokens=job.max_tokens, deadline=deadline.stage("llm"))
+                    if on_answer is not None:
+                        on_answer(job)
+                else:
+                    deadline = Deadline(config.job_deadline_seconds, config.job_stage_shares)
+                async with render_slots:
+                    job.file, job.title = await presentation.generate_ppt(job.answer, template, deadline=deadline)
+            finally:
+                if speculation is not None:
+                    speculation.finish()
+
+    results = await asyncio.gather(*(run(index, job) for index, job in enumerate(jobs)), return_exceptions=True)
+    for job, result in zip(jobs, results):
+        if isinstance(result, Exception):
+            job.error = result
+            metrics.FAILURES.labels("batch_deck").inc()
+            logger.warning(f"Batch deck {job.topic!r} failed: {result!r}")
+    return jobs
+
+
+def archive_name(index, title):
+    return f"{index:02d} {UNSAFE_FILENAME_CHARACTERS.sub('_', title)}"
+
+
+def archives(jobs, max_bytes):
+    """The finished decks zipped into as few spooled archives as fit in max_bytes each. The
+    decks are already deflated, so they are stored as they are."""
+    parts, part, size = [], [], 0
+    for index, job in enumerate(jobs, 1):
+        if job.file is None:
+            continue
+        deck_bytes = job.file.seek(0, io.SEEK_END)
+        if part and size + deck_bytes > max_bytes:
+            parts.append(part)
+            part, size = [], 0
+        part.append((index, job))
+        size += deck_bytes
+    if part:
+        parts.append(part)
+
+    def write(decks):
+        def write_zip(file):
+            with zipfile.ZipFile(file, "w", zipfile.ZIP_STORED) as zf:
+                for index, job in decks:
+                    job.file.seek(0)
+                    with zf.open(archive_name(index, job.title), "w", force_zip64=True) as entry:
+                        shutil.copyfileobj(job.file, entry)
+        return spool.save(write_zip)
+
+    return [write(decks) for decks in parts]
@@ -0,0 +1,29 @@
+import time
+
+STAGES = ("llm", "images", "render")
+DEFAULT_SHARES = {"llm": 0.6, "images": 0.3, "render": 0.1}
+
+
+class Deadline:
+    """Wall-clock budget of one generation job.
+
+    Every stage gets its share of what is left when it starts, relative to the shares
+    of the stages still to come, so time saved by a fast stage goes to the later ones.
+    Only the llm and images stages are cut short. The render share is merely kept out
+    of theirs, rendering and the upload run to completion however late they are.
+    """
+
+    def __init__(self, seconds, shares=None):
+        self.expires_at = time.monotonic() + seconds
+        self.shares = {**DEFAULT_SHARES, **(shares or {})}
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() == 0.0
+
+    def stage(self, name):
+        later = STAGES[STAGES.index(name):]
+        fraction = self.shares[name] / sum(self.shares[stage] for stage in later)
+        return Deadline(self.remaining() * fraction)
@@ -1,21 +1,50 @@
+import asyncio
 import imghdr
 import logging
 import re
+import time
 import urllib.parse
 
 from aiohttp import ClientSession
 
+import config
+import metrics
+
+try:
+    from hosts import host_table, hostname
+except ImportError:
+    from .hosts import host_table, hostname
+
+
+# links kept per query for later searches, more than enough for a few pages of failures
+MAX_KNOWN_LINKS = 50
+
+
+class InvalidImage(ValueError):
+    pass
+
 
 class Bing:
-    def __init__(self, query, limit, adult, timeout, filter='', blocked_sites=None, verbose=True):
+    def __init__(self, query, limit, adult, timeout, filter='', blocked_sites=None, verbose=True, max_pages=5,
+                 known_links=None, deadline=None):
         self.download_count = 0
-        self.image = 0
+        self.image = None
+        self.link = None
         self.query = query
         self.adult = adult
         self.filter = filter
-        self.blocked_sites = blocked_sites
+        # domains, their subdomains are blocked too
+        self.blocked_sites = frozenset(blocked_sites or ())
         self.verbose = verbose
         self.seen = set()
+        # [{"url": ..., "outcome": "ok" | "error" | "invalid" | None}] from an earlier search, see results()
+        self.known_links = known_links or []
+        # links found on the results pages of this search, ranked
+        self.found = []
+        # link -> outcome of its download in this search
+        self.outcomes = {}
+        # the Deadline of the job that started the search, None for a prefetch
+        self.deadline = deadline
 
         assert type(limit) == int, "limit must be integer"
         self.limit = limit
@@ -23,6 +52,7 @@ class Bing:
         self.timeout = timeout
 
         self.page_counter = 0
+        self.max_pages = max_pages
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36',
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
@@ -53,10 +83,7 @@ class Bing:
                 return shorthand
 
     async def save_image(self, link):
-        print(link)
-        for site in self.blocked_sites:
-            if site in link:
-                raise ValueError("Blocked site found in URL: " + link)
+        self.logger.debug(f"Saving image from {link}")
         async with ClientSession() as session:
             async with session.get(link, timeout=self.timeout) as response:
                 image = await response.read()
@@ -65,38 +92,70 @@ class Bing:
         if not imghdr.what(None, image) or imghdr.what(None, image) not in supported_formats:
             error_msg = f'Invalid image, not saving {link}'
             self.logger.error(error_msg)
-            raise ValueError(error_msg)
+            raise InvalidImage(error_msg)
 
         return image
 
     async def download_image(self, link):
         self.download_count += 1
+        started = time.monotonic()
         try:
             if self.verbose:
                 self.logger.info(f'[%] Downloading Image #{self.download_count} from {link}')
 
             image = await self.save_image(link)
+            self.link = link
+            host_table.observe(hostname(link), "ok", time.monotonic() - started)
+            self.outcomes[link] = "ok"
+            metrics.IMAGE_LINKS.labels("ok").inc()
 
             if self.verbose:
                 self.logger.info('[%] File Downloaded !\n')
             return image
 
+        except asyncio.CancelledError:
+            # the host only counts as failing if the job's deadline ran out while it was still
+            # answering, a search dropped by the image cache or a shutdown says nothing about it
+            if self.deadline is not None and self.deadline.expired():
+                host_table.observe(hostname(link), "error", time.monotonic() - started)
+                self.outcomes[link] = "error"
+            raise
         except Exception as e:
             self.download_count -= 1
+            outcome = "invalid" if isinstance(e, InvalidImage) else "error"
+            host_table.observe(hostname(link), outcome, time.monotonic() - started)
+            self.outcomes[link] = outcome
+            metrics.IMAGE_LINKS.labels(outcome).inc()
+            metrics.RETRIES.labels("image_link").inc()
             self.logger.error(f'[!] Issue getting: {link}\n[!] Error:: {e}')
 
+    async def download_links(self, links):
+        for link in links:
+            if self.download_count < self.limit and link not in self.seen:
+                self.seen.add(link)
+                self.image = await self.download_image(link)
+
     async def run(self):
+        # links found by an earlier search: the ones that worked, the untried ones, then the ones
+        # that failed to download but were images; the results pages are only fetched when these
+        # do not give enough images
+        known = [link["url"] for outcome in ("ok", None, "error")
+                 for link in self.known_links if link["outcome"] == outcome]
+        links, left_out = host_table.rank(known, self.blocked_sites)
+        metrics.IMAGE_LINKS.labels("skipped").inc(left_out)
+        await self.download_links(links)
+
         async with ClientSession() as session:
-            while self.download_count < self.limit:
+            while self.download_count < self.limit and self.page_counter < self.max_pages:
                 if self.verbose:
                     self.logger.info(f'\n\n[!!]Indexing page: {self.page_counter + 1}\n')
                 # Parse the page source and download pics
-                request_url = 'https://www.bing.com/images/async?q=' + urllib.parse.quote_plus(self.query) \
+                request_url = config.bing_base_url + '/images/async?q=' + urllib.parse.quote_plus(self.query) \
                               + '&first=' + str(self.page_counter) + '&count=' + str(self.limit) \
                               + '&adlt=' + self.adult + '&qft=' + (
                                   '' if self.filter is None else await self.get_filter(self.filter))
                 self.logger.debug(request_url)
-                async with session.get(request_url, headers=self.headers) as response:
+                async with session.get(request_url, headers=self.headers, timeout=self.timeout) as response:
                     html = await response.text()
                 self.logger.debug(html)
                 if html == "":
@@ -106,10 +165,20 @@ class Bing:
                 if self.verbose:
                     self.logger.info(f'[%] Indexed {len(links)} Images on Page {self.page_counter + 1}.')
                     self.logger.info('\n===============================================\n')
-                for link in links:
-                    if self.download_count < self.limit and link not in self.seen:
-                        self.seen.add(link)
-                        self.image = await self.download_image(link)
+                # blocked domains and hosts that keep failing are left out, fast reliable hosts go first
+                links, left_out = host_table.rank(links, self.blocked_sites)
+                metrics.IMAGE_LINKS.labels("skipped").inc(left_out)
+                self.found.extend(link for link in links if link not in self.found)
+                await self.download_links(links)
 
                 self.page_counter += 1
         self.logger.info(f'\n\n[%] Done. Downloaded {self.download_count} images.')
+
+    def results(self):
+        """The known and newly found links with what came of their downloads, for the next
+        search of the same query."""
+        known = {link["url"]: link["outcome"] for link in self.known_links}
+        for link in self.found:
+            known.setdefault(link, None)
+        return [{"url": url, "outcome": self.outcomes.get(url, outcome)}
+                for url, outcome in known.items()][:MAX_KNOWN_LINKS]
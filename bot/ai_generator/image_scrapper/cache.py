@@ -0,0 +1,137 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ImageCache:
+    """LRU of downloaded images, bounded by total size.
+
+    Downloads in flight are shared, so a request for a query that is already being fetched
+    (e.g. by a speculative prefetch) waits for that download instead of starting another one.
+
+    Images stay cached after the deck that embedded them is saved, on purpose: decks on the
+    same or a close topic ask for the same queries, and a hit saves a Bing search and a
+    download. The deck holds its own copy of the image, so what stays alive here is bounded
+    by max_bytes alone, with max_bytes=0 nothing outlives its downloads.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        # speculative key -> whether a real request has used it yet
+        self.speculative = {}
+
+    @staticmethod
+    def key(query, filter, adult):
+        return " ".join(query.lower().split()), filter, adult
+
+    def get_or_fetch(self, key, fetch, speculative=False):
+        """Returns a task resolving to the image bytes (or None)."""
+        if not speculative and key in self.speculative:
+            self.speculative[key] = True
+        elif speculative and key not in self.entries and key not in self.in_flight:
+            self.speculative[key] = False
+
+        if not speculative:
+            result = "hit" if key in self.entries else "shared" if key in self.in_flight else "miss"
+            metrics.CACHE_REQUESTS.labels("image", result).inc()
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(self.entries[key])
+            return future
+        if key not in self.in_flight:
+            task = asyncio.create_task(fetch())
+            task.add_done_callback(lambda done: self._store(key, done))
+            self.in_flight[key] = task
+        return self.in_flight[key]
+
+    def _store(self, key, task):
+        self.in_flight.pop(key, None)
+        if task.cancelled() or task.exception() is not None or task.result() is None:
+            return
+        image = task.result()
+        self.entries[key] = image
+        self.size += len(image)
+        while self.size > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    async def close(self):
+        """Cancels the downloads in flight and waits for them to close their connections."""
+        tasks = list(self.in_flight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def discard(self, key):
+        if key in self.in_flight:
+            self.in_flight.pop(key).cancel()
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+
+
+class Speculation:
+    """Images prefetched for queries guessed before the final [IMAGE] tags are known."""
+
+    queries = 0
+    hits = 0
+
+    def __init__(self, cache, keys):
+        self.cache = cache
+        self.keys = keys
+
+    def finish(self):
+        """Drops the speculative results no real request used and records the hit rate."""
+        for key in self.keys:
+            hit = self.cache.speculative.pop(key, None)
+            if hit is None:
+                continue
+            Speculation.queries += 1
+            metrics.CACHE_REQUESTS.labels("speculation", "hit" if hit else "miss").inc()
+            if hit:
+                Speculation.hits += 1
+            else:
+                self.cache.discard(key)
+        if Speculation.queries:
+            logger.info(f"Image speculation hit rate: {Speculation.hits}/{Speculation.queries} "
+                        f"({Speculation.hits / Speculation.queries:.0%})")
+
+
+class SharedResults:
+    """Links found for each query, shared with other replicas through read and write, e.g.
+    Mongo. Without them (the headless entry point), every search fetches the results pages."""
+
+    def __init__(self):
+        self.read = None
+        self.write = None
+
+    def connect(self, read, write):
+        self.read = read
+        self.write = write
+
+    async def get(self, key):
+        if self.read is None:
+            return None
+        try:
+            links = await asyncio.to_thread(self.read, key)
+        except Exception as e:
+            logger.error(f"Could not read the image results of {key}: {e}")
+            return None
+        metrics.CACHE_REQUESTS.labels("image_results", "miss" if links is None else "hit").inc()
+        return links
+
+    async def put(self, key, links, searched):
+        """Stores links, searched telling whether they include a fresh results page."""
+        if self.write is None or not links:
+            return
+        try:
+            await asyncio.to_thread(self.write, key, links, searched)
+        except Exception as e:
+            logger.error(f"Could not store the image results of {key}: {e}")
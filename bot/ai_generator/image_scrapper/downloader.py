@@ -1,25 +1,118 @@
+import asyncio
+import math
+
+import config
+import metrics
+import tracing
+
 try:
     from bing import Bing
+    from cache import ImageCache, SharedResults, Speculation
+    from library import ImageLibrary, MIN_COVERAGE
 except ImportError:
     from .bing import Bing
+    from .cache import ImageCache, SharedResults, Speculation
+    from .library import ImageLibrary, MIN_COVERAGE
 
+image_cache = ImageCache(config.image_cache_bytes)
+shared_results = SharedResults()
+image_library = ImageLibrary.load(config.image_library_dir)
 
-async def download(query, limit=100, adult_filter_off=True,
-                   timeout=60, filter="", block_sites=True, verbose=True):
+
+# domains whose images are watermarked or not hotlinkable, with their subdomains
+BLOCKED_SITES = frozenset(["alamy.com", "dreamstime.com", "istockphoto.com", "bigstockphoto.com", "slideserve.com",
+                           "chefspencil.com", "ppt-online.org", "shutterstock.com", "depositphotos.com",
+                           "focusedcollection.com", "pinimg.com", "gettyimages.com", "dissolve.com",
+                           "vseosvita.ua"])
+
+
+def start_download(query, limit=100, adult_filter_off=True,
+                   timeout=60, filter="", block_sites=True, verbose=True, deadline=None, speculative=False):
+    """Returns the (possibly shared) download task for query through the image cache."""
     if adult_filter_off:
         adult = 'off'
     else:
         adult = 'on'
-    blocked_sites = []
+    blocked_sites = frozenset()
     if block_sites:
-        blocked_sites = ["alamy.com", "dreamstime.com", "istockphoto.com", "bigstockphoto.com", "slideserve.com",
-                         "chefspencil.com", "ppt-online.org", "shutterstock.com", "depositphotos.com",
-                         "focusedcollection.com", "pinimg.com", "gettyimages.com", "dissolve.com",
-                         "vseosvita.ua"]
-
-    bing = Bing(query, limit, adult, timeout, filter, blocked_sites, verbose)
-    await bing.run()
-    return bing.image
+        blocked_sites = BLOCKED_SITES
+
+    if deadline is not None:
+        timeout = max(1, min(timeout, math.ceil(deadline.remaining())))
+    # a prefetch has no deadline, it still has to end: requests joining it wait for it
+    run_timeout = deadline.remaining() if deadline else timeout
+    key = image_cache.key(query, filter, adult)
+
+    async def fetch():
+        with tracing.span("bing", query=query, speculative=speculative) as span:
+            known_links = await shared_results.get(key)
+            bing = Bing(query, limit, adult, timeout, filter, blocked_sites, verbose, known_links=known_links,
+                        deadline=deadline)
+            try:
+                await asyncio.wait_for(bing.run(), timeout=run_timeout)
+            except asyncio.TimeoutError:
+                span["timed_out"] = True
+            except Exception as e:  # results page unreachable, keep whatever was downloaded
+                span["error"] = repr(e)
+            span["url"] = bing.link
+            span["pages"] = bing.page_counter
+            span["known_links"] = len(known_links or ())
+            await shared_results.put(key, bing.results(), searched=bing.page_counter > 0)
+        return bing.image
+
+    return image_cache.get_or_fetch(key, fetch, speculative=speculative)
+
+
+def library_lookup(query):
+    """The library's best image for query and its keyword coverage, and whether that answers
+    the query so Bing is not asked: it covers every keyword and the library goes first."""
+    path, coverage = image_library.lookup(query)
+    return path, coverage, config.image_library_first and coverage >= 1
+
+
+async def download(query, limit=100, adult_filter_off=True,
+                   timeout=60, filter="", block_sites=True, verbose=True, deadline=None):
+    if deadline is not None and deadline.expired():
+        return None
+    with metrics.STAGE_SECONDS.labels("image_download").time(), tracing.span("image", query=query) as span:
+        path, coverage, answered = library_lookup(query)
+        image = None
+        if not answered:
+            task = start_download(query, limit, adult_filter_off, timeout, filter, block_sites, verbose, deadline)
+            try:
+                # shielded, a download shared with other jobs is not cancelled by this one's deadline;
+                # joining one started by someone else waits no longer than this request's own budget
+                image = await asyncio.wait_for(asyncio.shield(task), timeout=deadline.remaining() if deadline else timeout)
+            except asyncio.TimeoutError:
+                pass
+        if image is None and path is not None and coverage >= MIN_COVERAGE:
+            image = await asyncio.to_thread(read_file, path)
+            span["library"] = path
+            metrics.CACHE_REQUESTS.labels("image_library", "hit" if coverage >= 1 else "partial").inc()
+        elif image is None:
+            metrics.CACHE_REQUESTS.labels("image_library", "miss").inc()
+        span["bytes"] = len(image) if image else 0
+    if image is None:
+        metrics.FAILURES.labels("image_download").inc()
+    return image
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def close():
+    await image_cache.close()
+
+
+def prefetch(queries, limit=1, adult_filter_off=True, timeout=15, filter=""):
+    """Starts warming the image cache for queries guessed before the completion is parsed."""
+    adult = 'off' if adult_filter_off else 'on'
+    queries = [query for query in queries if not library_lookup(query)[2]]
+    for query in queries:
+        start_download(query, limit, adult_filter_off, timeout, filter, verbose=False, speculative=True)
+    return Speculation(image_cache, [image_cache.key(query, filter, adult) for query in queries])
 
 
 if __name__ == '__main__':
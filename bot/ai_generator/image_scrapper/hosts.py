@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import time
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+# observations lose half their weight after this many seconds, so a host that recovers is tried again
+HALF_LIFE = 24 * 60 * 60
+# what an unknown host is assumed to be like, as if it had been tried PRIOR_ATTEMPTS times
+PRIOR_ATTEMPTS = 2
+PRIOR_FAILURE_RATE = 0.25
+PRIOR_SECONDS = 1.0
+# hosts failing this often over at least SKIP_MIN_ATTEMPTS recent attempts are not tried
+SKIP_FAILURE_RATE = 0.9
+SKIP_MIN_ATTEMPTS = 5
+# a link one place lower in the results is preferred if its host is expected this much faster
+POSITION_PENALTY = 0.25
+
+
+def hostname(link):
+    host = urllib.parse.urlsplit(link).hostname or ""
+    return host[4:] if host.startswith("www.") else host
+
+
+def is_blocked(host, domains):
+    """Whether host is one of domains or a subdomain of one, e.g. i.pinimg.com of pinimg.com."""
+    labels = host.split(".")
+    return any(".".join(labels[i:]) in domains for i in range(len(labels)))
+
+
+class HostStats:
+    """Exponentially decayed counts of the downloads from one host."""
+
+    __slots__ = ("attempts", "errors", "invalid", "seconds", "updated")
+
+    def __init__(self, attempts=0.0, errors=0.0, invalid=0.0, seconds=0.0, updated=None):
+        self.attempts = attempts
+        self.errors = errors
+        self.invalid = invalid
+        self.seconds = seconds
+        self.updated = time.time() if updated is None else updated
+
+    def decay(self, now):
+        factor = 0.5 ** (max(0.0, now - self.updated) / HALF_LIFE)
+        self.attempts *= factor
+        self.errors *= factor
+        self.invalid *= factor
+        self.seconds *= factor
+        self.updated = now
+
+    def add(self, outcome, seconds):
+        self.attempts += 1
+        self.errors += outcome == "error"
+        self.invalid += outcome == "invalid"
+        self.seconds += seconds
+
+    def failure_rate(self):
+        return ((self.errors + self.invalid + PRIOR_FAILURE_RATE * PRIOR_ATTEMPTS)
+                / (self.attempts + PRIOR_ATTEMPTS))
+
+    def expected_seconds(self):
+        """Time expected to be spent on this host per image it delivers."""
+        latency = (self.seconds + PRIOR_SECONDS * PRIOR_ATTEMPTS) / (self.attempts + PRIOR_ATTEMPTS)
+        return latency / max(1 - self.failure_rate(), 0.01)
+
+
+class HostTable:
+    """Reputation of the hosts images are downloaded from, shared by all jobs of the process.
+
+    Every download is recorded with its latency and outcome: ok, error (unreachable, timed
+    out, cancelled by the deadline) or invalid (HTML instead of an image, unsupported format).
+    The observations not yet persisted are kept apart, so that replicas can add theirs to the
+    shared table and load everyone's back, see take_pending, put_back and load.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.pending = {}
+
+    def observe(self, host, outcome, seconds):
+        now = time.time()
+        for table in (self.stats, self.pending):
+            stats = table.setdefault(host, HostStats(updated=now))
+            stats.decay(now)
+            stats.add(outcome, seconds)
+
+    def skipped(self, host):
+        stats = self.stats.get(host)
+        if stats is None:
+            return False
+        stats.decay(time.time())
+        return stats.attempts >= SKIP_MIN_ATTEMPTS and stats.failure_rate() >= SKIP_FAILURE_RATE
+
+    def expected_seconds(self, host):
+        return self.stats.get(host, HostStats()).expected_seconds()
+
+    def rank(self, links, blocked_domains=frozenset()):
+        """Returns the links worth trying, the most promising first, and how many were left out."""
+        candidates = []
+        for position, link in enumerate(links):
+            host = hostname(link)
+            if is_blocked(host, blocked_domains) or self.skipped(host):
+                continue
+            candidates.append((self.expected_seconds(host) + POSITION_PENALTY * position, position, link))
+        candidates.sort()
+        return [link for _, _, link in candidates], len(links) - len(candidates)
+
+    def take_pending(self):
+        """Hands over the observations since the last call as BSON-safe records."""
+        pending, self.pending = self.pending, {}
+        return [{"_id": host, "attempts": stats.attempts, "errors": stats.errors, "invalid": stats.invalid,
+                 "seconds": stats.seconds, "updated": stats.updated} for host, stats in pending.items()]
+
+    def put_back(self, records):
+        """Returns records of take_pending whose write failed, merged with the observations
+        made since, so the next sync writes them again."""
+        now = time.time()
+        for record in records:
+            taken = HostStats(record["attempts"], record["errors"], record["invalid"], record["seconds"],
+                              record["updated"])
+            pending = self.pending.setdefault(record["_id"], HostStats(updated=now))
+            taken.decay(now)
+            pending.decay(now)
+            for field in ("attempts", "errors", "invalid", "seconds"):
+                setattr(pending, field, getattr(pending, field) + getattr(taken, field))
+
+    def load(self, records):
+        """Replaces the table with the shared one, plus the observations it does not have yet."""
+        stats = {record["_id"]: HostStats(record["attempts"], record["errors"], record["invalid"],
+                                          record["seconds"], record["updated"]) for record in records}
+        now = time.time()
+        for host, pending in self.pending.items():
+            shared = stats.setdefault(host, HostStats(updated=now))
+            shared.decay(now)
+            pending.decay(now)
+            for field in ("attempts", "errors", "invalid", "seconds"):
+                setattr(shared, field, getattr(shared, field) + getattr(pending, field))
+        self.stats = stats
+
+
+host_table = HostTable()
+
+
+async def sync(write, read):
+    """Adds the observations of this process to the shared table and loads it back."""
+    records = host_table.take_pending()
+    if records:
+        try:
+            await asyncio.to_thread(write, records)
+        except Exception as e:
+            # kept for the next sync instead of being lost
+            host_table.put_back(records)
+            logger.error(f"Could not write the image host table: {e}")
+            return
+    try:
+        host_table.load(await asyncio.to_thread(read))
+    except Exception as e:
+        logger.error(f"Could not load the image host table: {e}")
+
+
+async def sync_periodically(write, read, interval=60):
+    while True:
+        await sync(write, read)
+        await asyncio.sleep(interval)
@@ -0,0 +1,115 @@
+"""Local image library, the fallback for image queries Bing does not answer in time.
+
+A library is a directory of curated jpeg, png and gif images. Each image is described by the
+words of its file name and, optionally, a text file next to it with the same name and any
+further keywords, in any language (mount_everest.jpg, mount_everest.txt: "Everest Эверест
+Everest tog'i Himalaya"). The inverted index of those keywords is built offline:
+
+    python bot/ai_generator/image_scrapper/library.py image_library/
+
+and written to image_library/index.json, which the bot loads at startup.
+"""
+import argparse
+import imghdr
+import json
+import logging
+import math
+import os
+import re
+import unicodedata
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "index.json"
+SUPPORTED_FORMATS = ("jpeg", "png", "gif")
+# share of the query's keyword weight an image has to match to stand in for a Bing result
+MIN_COVERAGE = 0.5
+
+# the apostrophes of Uzbek Latin (o'zbek, g'isht) are written in many ways
+APOSTROPHES = str.maketrans({"ʻ": "'", "ʼ": "'", "’": "'", "‘": "'", "`": "'"})
+WORD = re.compile(r"[^\W_]+(?:'[^\W_]+)*")
+
+
+def tokenize(text):
+    """Case-folded words of text in any script, without numbers and one-letter words."""
+    text = unicodedata.normalize("NFKC", text).translate(APOSTROPHES).casefold()
+    return [word for word in WORD.findall(text) if len(word) > 1 and not word.isdigit()]
+
+
+class ImageLibrary:
+    def __init__(self, directory=None, files=(), keywords=None):
+        self.directory = directory
+        self.files = list(files)
+        # keyword -> indices of the files it describes
+        self.keywords = keywords or {}
+
+    @classmethod
+    def load(cls, directory):
+        """The library indexed in directory, an empty one if there is none."""
+        path = os.path.join(directory, INDEX_FILE)
+        if not os.path.exists(path):
+            logger.info(f"No image library index at {path}")
+            return cls()
+        with open(path, encoding="utf-8") as f:
+            index = json.load(f)
+        logger.info(f"Image library: {len(index['files'])} images, {len(index['keywords'])} keywords")
+        return cls(directory, index["files"], index["keywords"])
+
+    def lookup(self, query):
+        """Returns the path of the image best matching query and the share of the query's
+        keyword weight it matches, or (None, 0). Rare keywords weigh more, and keywords no
+        image has count against the match."""
+        words = set(tokenize(query))
+        if not words or not self.files:
+            return None, 0
+        scores = defaultdict(float)
+        total = 0
+        for word in words:
+            indices = self.keywords.get(word, ())
+            weight = math.log(1 + len(self.files) / (len(indices) or 1))
+            total += weight
+            for index in indices:
+                scores[index] += weight
+        if not scores:
+            return None, 0
+        best = max(scores, key=lambda index: (scores[index], -index))
+        return os.path.join(self.directory, self.files[best]), scores[best] / total
+
+
+def build(directory):
+    """Indexes the images in directory and writes the index next to them."""
+    files = []
+    keywords = defaultdict(list)
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        stem, extension = os.path.splitext(name)
+        if extension.lower() in (".txt", ".json") or not os.path.isfile(path):
+            continue
+        if imghdr.what(path) not in SUPPORTED_FORMATS:
+            logger.warning(f"Skipping {name}, not a {'/'.join(SUPPORTED_FORMATS)} image")
+            continue
+        words = tokenize(stem)
+        description = os.path.join(directory, f"{stem}.txt")
+        if os.path.exists(description):
+            with open(description, encoding="utf-8") as f:
+                words += tokenize(f.read())
+        if not words:
+            logger.warning(f"Skipping {name}, it has no keywords")
+            continue
+        for word in sorted(set(words)):
+            keywords[word].append(len(files))
+        files.append(name)
+
+    with open(os.path.join(directory, INDEX_FILE), "w", encoding="utf-8") as f:
+        json.dump({"files": files, "keywords": keywords}, f, ensure_ascii=False)
+    return files, keywords
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    files, keywords = build(args.directory)
+    print(f"{args.directory}: {len(files)} images, {len(keywords)} keywords")
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import openai
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Backend:
+    """An OpenAI-compatible chat completions endpoint (OpenAI itself or a self-hosted server)
+    together with the latency and health observed for it."""
+
+    def __init__(self, name, api_base, api_key, model, latency_window=200):
+        self.name = name
+        self.api_base = api_base
+        self.api_key = api_key
+        self.model = model
+        self.latencies = deque(maxlen=latency_window)
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+    def is_healthy(self):
+        return time.monotonic() >= self.unhealthy_until
+
+    def latency_quantile(self, quantile):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+    def record_success(self, latency):
+        self.latencies.append(latency)
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+    def record_failure(self, failure_threshold, cooldown):
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= failure_threshold:
+            self.unhealthy_until = time.monotonic() + cooldown
+            logger.warning(f"LLM backend {self.name} marked unhealthy for {cooldown}s")
+
+    async def complete(self, messages, **options):
+        start = time.monotonic()
+        response = await openai.ChatCompletion.acreate(
+            model=self.model,
+            messages=messages,
+            api_key=self.api_key,
+            api_base=self.api_base,
+            **options
+        )
+        return response, time.monotonic() - start
+
+
+class Router:
+    """Sends each completion to the healthiest, fastest backend and hedges with a second
+    backend when the first has not answered within its observed p90 latency."""
+
+    def __init__(self, backends, hedge_quantile=0.9, default_hedge_delay=10.0, min_hedge_delay=1.0,
+                 min_samples=20, failure_threshold=3, cooldown=30.0):
+        self.backends = backends
+        self.hedge_quantile = hedge_quantile
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.min_samples = min_samples
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+    def ranked_backends(self):
+        def sort_key(backend):
+            median = backend.latency_quantile(0.5)
+            # backends without samples yet are tried first so that they get measured
+            return not backend.is_healthy(), median is not None, median or 0.0
+        return sorted(self.backends, key=sort_key)
+
+    def hedge_delay(self, backend):
+        if len(backend.latencies) < self.min_samples:
+            return self.default_hedge_delay
+        return max(self.min_hedge_delay, backend.latency_quantile(self.hedge_quantile))
+
+    async def complete(self, messages, **options):
+        candidates = deque(self.ranked_backends())
+        pending = {}
+        last_error = None
+
+        def launch():
+            backend = candidates.popleft()
+            task = asyncio.create_task(backend.complete(messages, **options))
+            pending[task] = backend, time.monotonic()
+            return backend
+
+        primary = launch()
+        try:
+            done, _ = await asyncio.wait(pending, timeout=self.hedge_delay(primary))
+            if not done and candidates:
+                hedge = launch()
+                metrics.RETRIES.labels("llm_hedge").inc()
+                logger.info(f"Hedging LLM request from {primary.name} to {hedge.name}")
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    backend, _ = pending.pop(task)
+                    try:
+                        response, latency = task.result()
+                    except openai.error.InvalidRequestError:
+                        raise  # the request itself is wrong, another backend will not help
+                    except Exception as e:
+                        last_error = e
+                        backend.record_failure(self.failure_threshold, self.cooldown)
+                        logger.warning(f"LLM backend {backend.name} failed: {e!r}")
+                        if not pending and candidates:
+                            launch()
+                            metrics.RETRIES.labels("llm_failover").inc()
+                        continue
+                    backend.record_success(latency)
+                    return response
+        finally:
+            for task, (backend, started) in pending.items():
+                task.cancel()
+                # the loser's latency is at least this long, keep it in the window so that
+                # a backend that keeps losing to hedges stops being ranked first
+                backend.latencies.append(time.monotonic() - started)
+        raise last_error
@@ -1,9 +1,25 @@
+import asyncio
+
 import config
+import metrics
+import tracing
 
 import openai
 
+try:
+    import llm_router
+    import token_budget
+except ImportError:
+    from . import llm_router
+    from . import token_budget
+
 openai.api_key = config.openai_api_key
 
+router = llm_router.Router(
+    [llm_router.Backend(**backend) for backend in config.llm_backends],
+    **config.llm_routing
+)
+
 OPENAI_COMPLETION_OPTIONS = {
     "temperature": 0.75,
     "max_tokens": 3072,
@@ -13,23 +29,82 @@ OPENAI_COMPLETION_OPTIONS = {
 }
 
 
-async def process_prompt(message):
+# complete parts of a tagged reply, a truncated one is continued after the last of them
+RESUME_AFTER = ("[SLIDEBREAK]", "[/CONTENT]")
+CONTINUE_PROMPT = ("Your answer was cut off. Continue it exactly where it stops, in the same format and "
+                   "language. Do not repeat anything that is already written and do not add any introduction.")
+
+
+async def complete(messages, deadline=None, **options):
+    """Returns the answer, why it ended ("stop", "length", ...) and the tokens used."""
     answer = None
     while answer is None:
         try:
-            response = await openai.ChatCompletion.acreate(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "user", "content": message}
-                ],
-                **OPENAI_COMPLETION_OPTIONS
-            )
+            with metrics.STAGE_SECONDS.labels("llm").time(), metrics.FAILURES.labels("llm").count_exceptions(), \
+                    tracing.span("llm", max_tokens=options["max_tokens"]) as span:
+                response = await asyncio.wait_for(router.complete(messages, **options),
+                                                  timeout=deadline.remaining() if deadline else None)
             answer = response['choices'][0]['message']['content']
+            finish_reason = response['choices'][0].get('finish_reason')
             n_used_tokens = response.usage.total_tokens
+            span["n_used_tokens"] = n_used_tokens
+            span["finish_reason"] = finish_reason
+        except asyncio.TimeoutError as e:
+            raise TimeoutError("Completion did not finish within the job deadline") from e
         except openai.error.InvalidRequestError as e:  # too many tokens
             raise ValueError("Too many tokens to make completion") from e
-        except openai.error.RateLimitError as e:
+        except (openai.error.RateLimitError, openai.error.ServiceUnavailableError) as e:
             raise OverflowError("That model is currently overloaded with other requests.") from e
+        except (openai.error.Timeout, openai.error.APIConnectionError) as e:
+            raise RuntimeError("Could not reach the completion API") from e
         except openai.error.APIError as e:
             raise RuntimeError("HTTP code 502 from API") from e
+    return answer, finish_reason, n_used_tokens
+
+
+def cut_at_boundary(answer):
+    """The answer up to the end of its last complete part, all of it if it has none."""
+    end = max(answer.rfind(marker) + len(marker) if marker in answer else 0 for marker in RESUME_AFTER)
+    return answer[:end] if end else answer
+
+
+def stitch(answer, tail):
+    if not answer.endswith(RESUME_AFTER):
+        return answer + tail  # cut off mid-text, continued mid-text
+    tail = tail.lstrip()
+    # the continuation sometimes opens with the marker the answer was cut after
+    for marker in RESUME_AFTER:
+        if answer.endswith(marker) and tail.startswith(marker):
+            tail = tail[len(marker):].lstrip()
+    return f"{answer}\n\n{tail}"
+
+
+async def process_prompt(message, deadline=None, **options):
+    """Completes message. An answer cut off by max_tokens is continued after its last
+    complete slide or section, up to config.llm_max_continuations times, so only the missing
+    tail is generated again; if it is still cut off, the incomplete part is dropped."""
+    options = {**OPENAI_COMPLETION_OPTIONS, **options}
+    max_tokens = options["max_tokens"]
+    options["max_tokens"] = token_budget.fit_max_tokens(message, max_tokens)
+    answer, finish_reason, n_used_tokens = await complete([{"role": "user", "content": message}], deadline,
+                                                          **options)
+    continuations = 0
+    while finish_reason == "length" and continuations < config.llm_max_continuations:
+        answer = cut_at_boundary(answer)
+        try:
+            options["max_tokens"] = token_budget.fit_max_tokens(message + answer + CONTINUE_PROMPT, max_tokens,
+                                                                n_messages=3)
+        except ValueError:
+            break  # no room left in the context window
+        metrics.RETRIES.labels("llm_continuation").inc()
+        tail, finish_reason, tail_tokens = await complete([
+            {"role": "user", "content": message},
+            {"role": "assistant", "content": answer},
+            {"role": "user", "content": CONTINUE_PROMPT},
+        ], deadline, **options)
+        n_used_tokens += tail_tokens
+        answer = stitch(answer, tail)
+        continuations += 1
+    if finish_reason == "length":
+        answer = cut_at_boundary(answer)
     return answer, n_used_tokens
@@ -0,0 +1,143 @@
+import hashlib
+import io
+import logging
+import posixpath
+import sys
+import zipfile
+import zlib
+from collections import OrderedDict
+
+from pptx.opc.oxml import serialize_part_xml
+from pptx.opc.packuri import CONTENT_TYPES_URI
+from pptx.opc.serialized import PackageWriter, _ContentTypesItem
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# already compressed formats, deflating them again costs CPU for a few bytes at best
+STORED_EXTENSIONS = {".jpeg", ".jpg", ".png", ".gif", ".wdp", ".jfif", ".mp3", ".m4a", ".mp4", ".m4v", ".wmv",
+                     ".avi", ".mov", ".zip"}
+# parts written anew for every deck, not worth a place in the cache
+UNCACHED_DIRECTORIES = ("ppt/slides/", "docProps/")
+DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# _ZipWriter reaches into zipfile internals that were checked against these versions only
+TESTED_PYTHON_VERSIONS = ((3, 8), (3, 12))
+ZIP_INTERNALS = ("_writecheck", "_didModify", "start_dir", "fp", "filelist", "NameToInfo")
+
+
+def zip_internals_supported():
+    """Whether this interpreter's zipfile is one _ZipWriter was written against."""
+    oldest, newest = TESTED_PYTHON_VERSIONS
+    if not oldest <= sys.version_info[:2] <= newest:
+        return False
+    with zipfile.ZipFile(io.BytesIO(), "w") as zipf:
+        return all(hasattr(zipf, attr) for attr in ZIP_INTERNALS)
+
+
+ZIP_WRITER_SUPPORTED = zip_internals_supported()
+if not ZIP_WRITER_SUPPORTED:
+    logger.warning(f"Python {sys.version.split()[0]} is not one the zip writer was checked against, "
+                   "decks are saved with python-pptx")
+
+
+class CompressedPartCache:
+    """Raw deflate streams of package parts keyed by name, BLAKE2b digest and level, bounded
+    by total compressed size. The master, layout and theme parts of a template serialize to the
+    same bytes in every deck, so they are compressed once and copied afterwards."""
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        data = self.entries.get(key)
+        metrics.CACHE_REQUESTS.labels("package_part", "miss" if data is None else "hit").inc()
+        if data is not None:
+            self.entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+compressed_parts = CompressedPartCache()
+
+
+class _ZipWriter:
+    """Writes entries into a zip with precomputed CRCs and compressed data, which zipfile
+    has no public API for, so media can be stored as is and cached parts copied raw."""
+
+    def __init__(self, pkg_file, level, cache):
+        self.zipf = zipfile.ZipFile(pkg_file, "w")
+        self.level = level
+        self.cache = cache
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.zipf.close()
+
+    def write(self, pack_uri, blob):
+        name = pack_uri.membername
+        crc = zlib.crc32(blob)
+        if posixpath.splitext(name)[1].lower() in STORED_EXTENSIONS:
+            self._write_entry(name, zipfile.ZIP_STORED, crc, len(blob), blob)
+            return
+
+        # a digest rather than the CRC, a collision would put another part's XML into the deck
+        key = (name, hashlib.blake2b(blob).digest(), self.level)
+        cacheable = not name.startswith(UNCACHED_DIRECTORIES)
+        data = self.cache.get(key) if cacheable else None
+        if data is None:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            data = compressor.compress(blob) + compressor.flush()
+            if cacheable:
+                self.cache.put(key, data)
+        self._write_entry(name, zipfile.ZIP_DEFLATED, crc, len(blob), data)
+
+    def _write_entry(self, name, compress_type, crc, size, data):
+        zinfo = zipfile.ZipInfo(name, date_time=DATE_TIME)
+        zinfo.compress_type = compress_type
+        zinfo.external_attr = 0o600 << 16
+        zinfo.CRC = crc
+        zinfo.file_size = size
+        zinfo.compress_size = len(data)
+        zipf = self.zipf
+        zipf._writecheck(zinfo)
+        zipf._didModify = True
+        zinfo.header_offset = zipf.fp.tell()
+        zipf.fp.write(zinfo.FileHeader())
+        zipf.fp.write(data)
+        zipf.filelist.append(zinfo)
+        zipf.NameToInfo[name] = zinfo
+        zipf.start_dir = zipf.fp.tell()
+
+
+class _PackageWriter(PackageWriter):
+    def __init__(self, pkg_file, pkg_rels, parts, level, cache):
+        super().__init__(pkg_file, pkg_rels, parts)
+        self._level = level
+        self._cache = cache
+
+    def _write(self):
+        with _ZipWriter(self._pkg_file, self._level, self._cache) as phys_writer:
+            phys_writer.write(CONTENT_TYPES_URI, serialize_part_xml(_ContentTypesItem.xml_for(self._parts)))
+            self._write_pkg_rels(phys_writer)
+            self._write_parts(phys_writer)
+
+
+def save(presentation, file, level=6, cache=compressed_parts):
+    """Drop-in for Presentation.save: media is stored without recompressing it, XML parts
+    are deflated at level and unchanged template parts are copied from the cache."""
+    if not ZIP_WRITER_SUPPORTED:
+        presentation.save(file)
+        return
+    package = presentation.part.package
+    _PackageWriter(file, package._rels, tuple(package.iter_parts()), level, cache)._write()
@@ -0,0 +1,128 @@
+"""The generation jobs of the bot's auto and manual modes, without Telegram.
+
+The bot persists a job record between its stages and settles its tokens itself, so it uses
+the *_job and run_* stages. generate_* and *_from_reply return the spooled file, its name
+and the tokens the completions used. The exceptions of process_prompt are passed on:
+ValueError for a prompt too long for the model, OverflowError when the backends are
+overloaded, RuntimeError when they cannot be reached and TimeoutError when the deadline
+passes.
+"""
+import config
+
+try:
+    from image_scrapper import downloader
+    from deadline import Deadline
+    import abstract
+    import openai_utils
+    import presentation
+    import templates
+    import token_budget
+except ImportError:
+    from .image_scrapper import downloader
+    from .deadline import Deadline
+    from . import abstract
+    from . import openai_utils
+    from . import presentation
+    from . import templates
+    from . import token_budget
+
+SLIDE_COUNTS = range(4, 16)
+
+
+def check_slide_count(slide_count):
+    if int(slide_count) not in SLIDE_COUNTS:
+        raise ValueError(f"slide count must be between {SLIDE_COUNTS.start} and {SLIDE_COUNTS.stop - 1}")
+
+
+def check_template(template):
+    if template not in templates.names():
+        raise ValueError(f"unknown template {template!r}, expected one of {', '.join(templates.names())}")
+
+
+async def presentation_job(language, emotion_type, slide_count, topic, template):
+    """The record of a deck to generate: its prompt, the max_tokens of the completion, what the
+    completion is expected to cost and the image queries prefetched while it runs. Raises
+    ValueError when the prompt leaves no room for the reply."""
+    check_slide_count(slide_count)
+    check_template(template)
+    prompt = await presentation.generate_ppt_prompt(language, emotion_type, slide_count, topic)
+    return {
+        "prompt": prompt,
+        "template_choice": template,
+        "max_tokens": token_budget.fit_max_tokens(prompt, token_budget.presentation_max_tokens(slide_count)),
+        "expected_tokens": token_budget.expected_presentation_cost(prompt, slide_count),
+        "image_queries": await presentation.speculative_image_queries(emotion_type, topic),
+    }
+
+
+async def run_presentation(job, on_answer=None, deadline=None):
+    """Completes and renders the deck of job. A job with its "answer" already, one resumed after
+    a restart, is only rendered. Otherwise the answer is stored in the job and
+    on_answer(n_used_tokens) called before rendering starts."""
+    deadline = deadline or Deadline(config.job_deadline_seconds, config.job_stage_shares)
+    if job.get("answer") is not None:
+        return await presentation.generate_ppt(job["answer"], job["template_choice"], deadline=deadline)
+    # warm the image cache with likely queries while the model is still generating
+    speculation = downloader.prefetch(job["image_queries"], timeout=15, filter=presentation.IMAGE_FILTER)
+    try:
+        answer, n_used_tokens = await openai_utils.process_prompt(job["prompt"], max_tokens=job["max_tokens"],
+                                                                  deadline=deadline.stage("llm"))
+        job["answer"] = answer
+        if on_answer is not None:
+            on_answer(n_used_tokens)
+        return await presentation.generate_ppt(answer, job["template_choice"], deadline=deadline)
+    finally:
+        speculation.finish()
+
+
+async def generate_presentation(language, emotion_type, slide_count, topic, template, deadline=None):
+    job = await presentation_job(language, emotion_type, slide_count, topic, template)
+    n_used_tokens = []
+    pptx_file, pptx_title = await run_presentation(job, on_answer=n_used_tokens.append, deadline=deadline)
+    return pptx_file, pptx_title, sum(n_used_tokens)
+
+
+async def presentation_from_reply(reply, template):
+    """A deck from a tagged reply pasted from another chat, the manual mode."""
+    check_template(template)
+    pptx_file, pptx_title = await presentation.generate_ppt(reply, template)
+    return pptx_file, pptx_title, 0
+
+
+async def abstract_job(language, emotion_type, topic):
+    """The record of an abstract to generate, see run_abstract."""
+    return {
+        "prompt": await abstract.generate_docx_prompt(language, emotion_type, topic),
+        "language_choice": language,
+        "type_choice": emotion_type,
+        "topic_choice": topic,
+    }
+
+
+async def run_abstract(job, on_answer=None, deadline=None):
+    """Completes and renders the abstract of job, in sections with config.abstract_two_phase.
+    The answer and on_answer work as in run_presentation."""
+    deadline = deadline or Deadline(config.job_deadline_seconds, config.job_stage_shares)
+    if job.get("answer") is None:
+        if config.abstract_two_phase:
+            answer, n_used_tokens = await abstract.generate_docx_sections(
+                job["language_choice"], job["type_choice"], job["topic_choice"],
+                max_concurrency=config.abstract_section_concurrency, deadline=deadline.stage("llm"))
+        else:
+            answer, n_used_tokens = await openai_utils.process_prompt(job["prompt"], deadline=deadline.stage("llm"))
+        job["answer"] = answer
+        if on_answer is not None:
+            on_answer(n_used_tokens)
+    return await abstract.generate_docx(job["answer"], deadline=deadline)
+
+
+async def generate_abstract(language, emotion_type, topic, deadline=None):
+    job = await abstract_job(language, emotion_type, topic)
+    n_used_tokens = []
+    docx_file, docx_title = await run_abstract(job, on_answer=n_used_tokens.append, deadline=deadline)
+    return docx_file, docx_title, sum(n_used_tokens)
+
+
+async def abstract_from_reply(reply):
+    docx_file, docx_title = await abstract.generate_docx(reply)
+    return docx_file, docx_title, 0
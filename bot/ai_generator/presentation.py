@@ -1,13 +1,36 @@
 import io
-import os
+import logging
 import re
 
-from pptx import Presentation
+import config
+import metrics
+import tracing
 
 try:
     from image_scrapper import downloader
+    import packaging
+    import spool
+    import templates
 except ImportError:
     from .image_scrapper import downloader
+    from . import packaging
+    from . import spool
+    from . import templates
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FILTER = "+filterui:aspect-wide+filterui:imagesize-wallpaper+filterui:photo-photo"
+# english keywords the model tends to add to image descriptions for a presentation type
+TYPE_IMAGE_KEYWORDS = {
+    "Ilmiy": "science",
+    "Biografik": "portrait",
+    "Tarixiy": "history",
+    "Sport": "sport",
+    "Sayohat": "travel",
+    "Musiqiy": "music",
+    "Ovqat pishirish": "food",
+    "Hujjatli film": "documentary",
+}
 
 
 async def generate_ppt_prompt(language, emotion_type, slide_length, topic):
@@ -67,54 +90,52 @@ Commit to the prescribed format with unwavering precision, eschewing superfluous
     return message
 
 
-async def generate_ppt(answer, template):
-    template = os.path.join("bot", "ai_generator", "presentation_templates", f"{template}.pptx")
-    root = Presentation(template)
-
-    # """ Ref for slide types:
-    # 0 -> title and subtitle
-    # 1 -> title and content
-    # 2 -> section header
-    # 3 -> two content
-    # 4 -> Comparison
-    # 5 -> Title only
-    # 6 -> Blank
-    # 7 -> Content with caption
-    # 8 -> Pic with caption
-    # """
-
-    async def delete_all_slides():
-        for i in range(len(root.slides) - 1, -1, -1):
-            r_id = root.slides._sldIdLst[i].rId
-            root.part.drop_rel(r_id)
-            del root.slides._sldIdLst[i]
+async def speculative_image_queries(emotion_type, topic):
+    topic = " ".join(re.sub(r"[?!.,:;\"']", " ", topic).split()).title()
+    queries = [topic]
+    if emotion_type in TYPE_IMAGE_KEYWORDS:
+        queries.append(f"{topic} {TYPE_IMAGE_KEYWORDS[emotion_type].title()}")
+    return queries
+
+
+async def generate_ppt(answer, template, deadline=None):
+    root = templates.load(template)
 
     async def create_title_slide(title, subtitle):
-        layout = root.slide_layouts[0]
+        layout = root.slide_layouts[templates.TITLE_LAYOUT]
         slide = root.slides.add_slide(layout)
         slide.shapes.title.text = title
         slide.placeholders[1].text = subtitle
 
     async def create_section_header_slide(title):
-        layout = root.slide_layouts[2]
+        layout = root.slide_layouts[templates.SECTION_HEADER_LAYOUT]
         slide = root.slides.add_slide(layout)
         slide.shapes.title.text = title
 
     async def create_title_and_content_slide(title, content):
-        layout = root.slide_layouts[1]
+        layout = root.slide_layouts[templates.CONTENT_LAYOUT]
         slide = root.slides.add_slide(layout)
         slide.shapes.title.text = title
         slide.placeholders[1].text = content
 
     async def create_title_and_content_and_image_slide(title, content, image_query):
-        layout = root.slide_layouts[8]
+        image_data = None
+        try:
+            image_data = await downloader.download(image_query, limit=1, adult_filter_off=True, timeout=15,
+                                                   filter=IMAGE_FILTER, deadline=image_deadline)
+        except Exception:
+            pass
+        if image_data is None:
+            # no picture in time, degrade to a text-only slide instead of an empty placeholder
+            await create_title_and_content_slide(title, content)
+            return
+
+        layout = root.slide_layouts[templates.PICTURE_LAYOUT]
         slide = root.slides.add_slide(layout)
         slide.shapes.title.text = title
         slide.placeholders[2].text = content
 
         try:
-            image_data = await downloader.download(image_query, limit=1, adult_filter_off=True, timeout=15,
-                                                   filter="+filterui:aspect-wide+filterui:imagesize-wallpaper+filterui:photo-photo")
             slide.placeholders[1].insert_picture(io.BytesIO(image_data))
         except Exception:
             pass
@@ -161,12 +182,11 @@ async def generate_ppt(answer, template):
     async def find_title():
         return root.slides[0].shapes.title.text
 
-    await delete_all_slides()
-    await parse_response(answer)
-    buffer = io.BytesIO()
-    root.save(buffer)
-    pptx_bytes = buffer.getvalue()
+    image_deadline = deadline.stage("images") if deadline else None
+    with metrics.STAGE_SECONDS.labels("render").time(), tracing.span("render", template=template):
+        await parse_response(answer)
+    pptx_file = spool.save(lambda file: packaging.save(root, file, level=config.pptx_compress_level))
     pptx_title = f"{await find_title()}.pptx"
-    print(f"done {pptx_title}")
+    logger.info(f"Rendered {pptx_title}")
 
-    return pptx_bytes, pptx_title
+    return pptx_file, pptx_title
@@ -0,0 +1,26 @@
+import tempfile
+
+import config
+import metrics
+import tracing
+
+
+class Spool(tempfile.SpooledTemporaryFile):
+    # an in-memory SpooledTemporaryFile has None for a name, which PTB's InputFile cannot
+    # take; the name is only reported, uploads pass their own filename
+    name = "document"
+
+
+def save(write):
+    """Saves a document with write(file) for upload without copying it.
+
+    The file stays in memory up to config.render_spool_bytes and rolls over to a temporary
+    file beyond that. It is returned rewound, the caller closes it after the upload.
+    """
+    file = Spool(max_size=config.render_spool_bytes)
+    with metrics.STAGE_SECONDS.labels("save").time(), tracing.span("save") as span:
+        write(file)
+        span["bytes"] = file.tell()
+        span["spooled"] = 0 < config.render_spool_bytes < file.tell()
+    file.seek(0)
+    return file
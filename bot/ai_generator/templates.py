@@ -0,0 +1,110 @@
+"""Slimmed presentation templates.
+
+The templates carry many layouts, sample slides, thumbnails and the media only those use,
+while generate_ppt needs four layouts. Every template is slimmed down to them once and the
+result kept in memory, so each deck is parsed, saved and uploaded without the rest.
+
+To look at the slimmed templates, write them to a directory (the originals are untouched):
+
+    python bot/ai_generator/templates.py slimmed_templates/
+"""
+import argparse
+import functools
+import io
+import logging
+import os
+
+from pptx import Presentation
+from pptx.opc.constants import RELATIONSHIP_TYPE as RT
+
+logger = logging.getLogger(__name__)
+
+TEMPLATES_DIR = os.path.join("bot", "ai_generator", "presentation_templates")
+
+# indices of the layouts generate_ppt uses in the original templates, kept in this order
+LAYOUTS = (0, 1, 2, 8)
+# and their indices in the slimmed templates
+TITLE_LAYOUT, CONTENT_LAYOUT, SECTION_HEADER_LAYOUT, PICTURE_LAYOUT = range(len(LAYOUTS))
+# placeholder idx generate_ppt fills in each of them, 0 is the title
+REQUIRED_PLACEHOLDERS = {
+    TITLE_LAYOUT: (0, 1),
+    CONTENT_LAYOUT: (0, 1),
+    SECTION_HEADER_LAYOUT: (0,),
+    PICTURE_LAYOUT: (0, 1, 2),
+}
+
+
+def names():
+    return sorted(os.path.splitext(name)[0] for name in os.listdir(TEMPLATES_DIR) if name.endswith(".pptx"))
+
+
+def slim(path):
+    """Returns the template at path without its slides, unused layouts and masters, the
+    thumbnail and every part only those referred to. Raises ValueError when one of the
+    kept layouts lacks a placeholder generate_ppt fills."""
+    root = Presentation(path)
+
+    for i in range(len(root.slides) - 1, -1, -1):
+        root.part.drop_rel(root.slides._sldIdLst[i].rId)
+        del root.slides._sldIdLst[i]
+
+    layouts = root.slide_layouts
+    if len(layouts) <= max(LAYOUTS):
+        raise ValueError(f"{path}: {len(layouts)} layouts, expected at least {max(LAYOUTS) + 1}")
+    for i in range(len(layouts) - 1, -1, -1):
+        if i not in LAYOUTS:
+            layouts.remove(layouts[i])
+
+    # generate_ppt only uses the layouts of the first master
+    for master_id in root.slide_masters._sldMasterIdLst.sldMasterId_lst[1:]:
+        root.part.drop_rel(master_id.rId)
+        root.slide_masters._sldMasterIdLst.remove(master_id)
+
+    package_rels = root.part.package._rels
+    # iterating _Relationships yields the relationships, not their rIds
+    for rel in list(package_rels):
+        if rel.reltype == RT.THUMBNAIL:
+            package_rels.pop(rel.rId)
+
+    for index, placeholders in REQUIRED_PLACEHOLDERS.items():
+        layout = root.slide_layouts[index]
+        present = {placeholder.placeholder_format.idx for placeholder in layout.placeholders}
+        for idx in placeholders:
+            if idx not in present:
+                raise ValueError(f"{path}: layout {layout.name!r} has no placeholder {idx}")
+
+    buffer = io.BytesIO()
+    root.save(buffer)
+    return buffer.getvalue()
+
+
+@functools.lru_cache(maxsize=None)
+def slimmed(name):
+    path = os.path.join(TEMPLATES_DIR, f"{name}.pptx")
+    data = slim(path)
+    logger.info(f"Template {name}: {os.path.getsize(path) // 1024} KiB slimmed to {len(data) // 1024} KiB")
+    return data
+
+
+def load(name):
+    """A new Presentation of the slimmed template, see the *_LAYOUT indices."""
+    return Presentation(io.BytesIO(slimmed(name)))
+
+
+def warm_up():
+    """Slims every template up front, failing early on a template generate_ppt cannot fill."""
+    for name in names():
+        slimmed(name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output_dir")
+    args = parser.parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    for template in names():
+        source = os.path.join(TEMPLATES_DIR, f"{template}.pptx")
+        data = slim(source)
+        with open(os.path.join(args.output_dir, f"{template}.pptx"), "wb") as f:
+            f.write(data)
+        print(f"{template}: {os.path.getsize(source) // 1024} KiB -> {len(data) // 1024} KiB")
@@ -0,0 +1,54 @@
+import functools
+import logging
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+MODEL = "gpt-3.5-turbo"
+MODEL_CONTEXT_TOKENS = 4096
+MESSAGE_OVERHEAD_TOKENS = 8  # role and separators added by the chat format
+MIN_COMPLETION_TOKENS = 256
+
+PRESENTATION_BASE_TOKENS = 256
+PRESENTATION_TOKENS_PER_SLIDE = 160  # ceiling for max_tokens
+PRESENTATION_EXPECTED_TOKENS_PER_SLIDE = 80  # typical usage, for the balance check
+
+
+@functools.lru_cache(maxsize=1)
+def get_encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(MODEL)
+    except Exception as e:  # the BPE file is downloaded on first use
+        logger.warning(f"Tokenizer is not available, falling back to an estimate: {e}")
+        return None
+
+
+def count_tokens(text):
+    encoding = get_encoding()
+    if encoding is None:
+        # conservative for non-latin scripts, which take more than one token per character
+        return len(text.encode("utf-8")) // 3 + 1
+    return len(encoding.encode(text))
+
+
+def presentation_max_tokens(slide_count):
+    return PRESENTATION_BASE_TOKENS + int(slide_count) * PRESENTATION_TOKENS_PER_SLIDE
+
+
+def expected_presentation_cost(prompt, slide_count):
+    return count_tokens(prompt) + MESSAGE_OVERHEAD_TOKENS + int(slide_count) * PRESENTATION_EXPECTED_TOKENS_PER_SLIDE
+
+
+def fit_max_tokens(prompt, max_tokens, n_messages=1):
+    """Trims max_tokens to what is left of the context window after the prompt, the text of
+    n_messages messages, raises ValueError when not even MIN_COMPLETION_TOKENS fit."""
+    available = MODEL_CONTEXT_TOKENS - count_tokens(prompt) - n_messages * MESSAGE_OVERHEAD_TOKENS
+    if available < MIN_COMPLETION_TOKENS:
+        raise ValueError("Too many tokens to make completion")
+    return min(max_tokens, available)
@@ -1,3 +1,6 @@
+# first, so the startup report includes the imports
+import startup
+
 import os
 from telegram import ReplyKeyboardMarkup, KeyboardButton
 import asyncio
@@ -5,22 +8,46 @@ import html
 import json
 import logging
 import traceback
-from datetime import datetime
-
-import ai_generator.abstract as abstract
-
-import ai_generator.openai_utils as openai_utils
-import ai_generator.presentation as presentation
+from datetime import datetime, timedelta
+
+# the rendering and LLM stacks are imported in the background once the bot polls, see warm_up
+abstract = startup.LazyModule("ai_generator.abstract")
+batch = startup.LazyModule("ai_generator.batch")
+downloader = startup.LazyModule("ai_generator.image_scrapper.downloader")
+hosts = startup.LazyModule("ai_generator.image_scrapper.hosts")
+presentation = startup.LazyModule("ai_generator.presentation")
+templates = startup.LazyModule("ai_generator.templates")
+pipeline = startup.LazyModule("ai_generator.pipeline")
+GENERATION_STACK = (abstract, batch, downloader, hosts, presentation, templates, pipeline)
 
 import config
 
 import database
 
+import jobs
+
+import membership
+
+import metrics
+
+import profiling
+
+import rate_limiter
+
+import session_store
+
+import tracing
+
+import usage
+
 import telegram
 from telegram import (
     BotCommand,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    Chat,
+    InputMediaDocument,
+    Message,
     Update,
     User,
 )
@@ -40,6 +67,10 @@ from telegram.ext import (
 
 # setup
 db = database.Database()
+memberships = membership.MembershipCache(config.membership_ttl, config.membership_negative_ttl)
+sessions = None
+generation_jobs = jobs.JobRegistry()
+background_tasks = []
 logger = logging.getLogger(__name__)
 
 CHAT_MODES = config.chat_modes
@@ -53,12 +84,113 @@ HELP_MESSAGE = """<b>Buyruqlar:</b>
 
 
 async def post_init(application: Application):
-    await application.bot.set_my_commands([
-        BotCommand("/menu", "Menyuni ko'rish"),
-        BotCommand("/mode", "Rejimni tanlash"),
-        BotCommand("/balance", "Balansni ko'rish"),
-        BotCommand("/help", "Yordam"),
-    ])
+    startup.mark("initialize")
+    background_tasks.append(asyncio.get_event_loop().create_task(tracing.flush_periodically(db.add_traces)))
+    background_tasks.append(asyncio.get_event_loop().create_task(usage.flush_periodically(db.add_usage_events)))
+    background_tasks.append(asyncio.get_event_loop().create_task(
+        usage.roll_up_periodically(db.roll_up_usage, config.usage_rollup_interval)))
+    background_tasks.append(asyncio.get_event_loop().create_task(sessions.sweep_periodically()))
+    # polling starts when post_init returns, everything else is done meanwhile
+    background_tasks.append(asyncio.get_event_loop().create_task(warm_up(application)))
+    startup.mark("post_init")
+    startup.report("Polling", ["imports", "build", "initialize", "post_init"])
+
+
+async def warm_up(application: Application):
+    try:
+        with startup.phase("database"):
+            await asyncio.to_thread(db.create_collections)
+        with startup.phase("generation_stack"):
+            await asyncio.to_thread(lambda: [module.load() for module in GENERATION_STACK])
+        background_tasks.append(asyncio.get_event_loop().create_task(
+            hosts.sync_periodically(write_image_hosts, db.get_image_hosts)))
+        downloader.shared_results.connect(db.get_image_results, db.put_image_results)
+        with startup.phase("templates"):
+            await asyncio.to_thread(templates.warm_up)
+        with startup.phase("commands"):
+            await application.bot.set_my_commands([
+                BotCommand("/menu", "Menyuni ko'rish"),
+                BotCommand("/mode", "Rejimni tanlash"),
+                BotCommand("/balance", "Balansni ko'rish"),
+                BotCommand("/help", "Yordam"),
+            ])
+        await resume_jobs(application)
+    except Exception as e:
+        logger.error(f"Warm-up failed: {e}")
+        raise
+    startup.report("Warm", ["database", "generation_stack", "templates", "commands"])
+
+
+def write_image_hosts(records):
+    db.add_image_hosts(records, hosts.HALF_LIFE)
+
+
+async def post_stop(application: Application):
+    """Runs once no more updates are processed, so no new generations are started: gives the
+    ones in flight config.shutdown_drain_seconds to deliver and persists the rest."""
+    unfinished = await generation_jobs.drain(config.shutdown_drain_seconds)
+    if not unfinished:
+        return
+    logger.warning(f"Persisting {len(unfinished)} unfinished generation jobs")
+    await asyncio.to_thread(db.save_jobs, unfinished)
+    for job in unfinished:
+        if job.get("notification_message_id") is None:
+            continue
+        try:
+            await application.bot.edit_message_text(
+                "⌛ Bot qayta ishga tushirilmoqda. Tayyor bo'lishi bilan yuboriladi.",
+                chat_id=job["chat_id"], message_id=job["notification_message_id"])
+        except telegram.error.TelegramError:
+            pass
+
+
+async def post_shutdown(application: Application):
+    await jobs.cancel(*background_tasks)
+    await tracing.flush(db.add_traces)
+    await usage.flush(db.add_usage_events)
+    await hosts.sync(write_image_hosts, db.get_image_hosts)
+    # shared image downloads outlive the jobs that started them
+    await downloader.close()
+    db.client.close()
+
+
+async def resume_jobs(application: Application):
+    """Restarts the jobs the previous run persisted in post_stop."""
+    for job in await asyncio.to_thread(db.pop_jobs):
+        message = Message(message_id=job["message_id"], date=datetime.now(),
+                          chat=Chat(id=job["chat_id"], type=Chat.PRIVATE))
+        message.set_bot(application.bot)
+        update = Update(update_id=0, message=message)
+        if job.get("notification_message_id") is not None:
+            try:
+                await application.bot.delete_message(job["chat_id"], job["notification_message_id"])
+            except telegram.error.TelegramError:
+                pass
+        if job.get("delivered"):
+            # the shutdown cut its upload short, the document may be in the chat already
+            logger.info(f"Not resending the {job['kind']} job of user {job['user_id']}")
+            continue
+        logger.info(f"Resuming {job['kind']} job of user {job['user_id']}")
+        spawn_generation(job["kind"], GENERATIONS[job["kind"]](update, job), tracing.Trace(job["kind"], job["user_id"]),
+                         job)
+
+
+def spawn_generation(kind, coroutine, trace, job):
+    """Starts a generation job, job being the record it is resumed from after a restart."""
+    metrics.QUEUE_DEPTH.labels("generation").inc()
+
+    async def run():
+        metrics.QUEUE_DEPTH.labels("generation").dec()
+        with metrics.JOBS_IN_FLIGHT.labels(kind).track_inprogress(), trace.activate(), tracing.span("job") as span:
+            peak_rss = metrics.peak_rss_bytes()
+            try:
+                await coroutine
+            finally:
+                span["peak_rss"] = metrics.peak_rss_bytes()
+                metrics.JOB_PEAK_RSS_GROWTH.labels(kind).observe(span["peak_rss"] - peak_rss)
+                trace.finish()
+
+    return generation_jobs.spawn(run(), job)
 
 
 def split_text_into_chunks(text, chunk_size):
@@ -75,6 +207,7 @@ async def register_user_if_not_exists(update: Update, context: CallbackContext,
             first_name=user.first_name,
             last_name=user.last_name
         )
+        usage.record("signup", user.id, documents=0)
 
 
 async def start_handle(update: Update, context: CallbackContext):
@@ -161,6 +294,8 @@ TYPES_EMOJI = ["🔬","📚","🎨","📜","😂", "😐", "🌟", "💪", "👨
 COUNTS = [str(i) for i in range(4, 16)]
 COUNTS_EMOJI = ["", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", ""]
 BACK = "⬅️Back"
+# a list of topics, not a document that happens to be a .txt
+BATCH_FILE_MAX_BYTES = 64 * 1024
 (
     PRESENTATION_LANGUAGE_CHOICE,
     ABSTRACT_LANGUAGE_CHOICE,
@@ -175,20 +310,7 @@ BACK = "⬅️Back"
 ) = map(chr, range(10, 20))
 
 async def check_user_channels(update: Update, context: CallbackContext) -> bool:
-    user = update.effective_user
-    print("User ID:", user.id)
-    required_channels = ["-1002109445838"]  # Add your required channel IDs here
-    for channel in required_channels:
-        try:
-            chat_member = await context.bot.get_chat_member(chat_id=channel, user_id=user.id)
-            print("Chat member status:", chat_member.status)
-            if chat_member.status not in ["member", "administrator", "creator"]:
-                return False
-        except telegram.error.BadRequest as e:
-            # Handle the case where the user is not found in the channel
-            print(f"User not found in channel {channel}: {e}")
-            return False
-    return True
+    return await memberships.check(context.bot, config.required_channels, update.effective_user.id)
 
 
 async def menu_handle(update: Update, context: CallbackContext) -> str:
@@ -204,7 +326,7 @@ async def menu_handle(update: Update, context: CallbackContext) -> str:
             pass
 
     if not await check_user_channels(update, context):
-        await update.message.reply_text("Botdan foydalanish uchun quyidagi kanallarga obuna bo'ling va qaytadan urinib ko'ring:\n\n👉 <a href='https://t.me/presento_ai'>Presento AI</a>", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
+        await update.effective_message.reply_text("Botdan foydalanish uchun quyidagi kanallarga obuna bo'ling va qaytadan urinib ko'ring:\n\n👉 <a href='https://t.me/presento_ai'>Presento AI</a>", parse_mode=ParseMode.HTML)
         return
     
     # If the user has joined the required channels, display the menu with inline buttons
@@ -354,6 +476,7 @@ async def presentation_topic_callback(update: Update, context: CallbackContext)
     "\n5. Men butun dunyo ma'lumotlari asosida taqdimot tayyorlayman. Agar O'zbekistonga oid ma'lumot kerak bo'lsa, mavzuni kiritishda davlat nomini ham kiritgan ma'qul."
     "\n6. Shaxslar tog'risida taqdimot yaratishda, shaxs haqida aniqroq ma'lumot berishga urinib ko'ring."
     "\n7. Qisqartma so'zlarga, imloviy xato so'zlarga tushunmasligim mumkin."
+    f"\n8. Bir nechta taqdimot kerak bo'lsa, /batch buyrug'idan keyin har bir mavzuni yangi qatordan yozing yoki mavzular ro'yxatini .txt/.csv fayl qilib yuboring (ko'pi bilan {config.batch_max_topics} ta)."
     "\n ❗️ Agar kiritilgan mavzuga tushunmasam boshqa mavzuga chalg'ib ketishim ehtimoli mavjud. Iltimos, mavzuni tasvirlashda e'tiborli bo'ling!")
     context.user_data[COUNT_SLIDE_CHOICE] = data
     await query.answer()
@@ -386,10 +509,22 @@ async def abstract_topic_callback(update: Update, context: CallbackContext) -> s
     return INPUT_TOPIC
 
 
-async def auto_generate_presentation(update: Update, context: CallbackContext, user_id, message_id, prompt, template_choice):
+def charge_tokens(kind, user_id, n_used_tokens):
+    available_tokens = db.get_user_attribute(user_id, "n_available_tokens")
+    db.set_user_attribute(user_id, "n_available_tokens", available_tokens - n_used_tokens)
+    used_tokens = db.get_user_attribute(user_id, "n_used_tokens")
+    db.set_user_attribute(user_id, "n_used_tokens", n_used_tokens + used_tokens)
+    usage.record(kind, user_id, tokens=n_used_tokens)
+
+
+async def generate_presentation(update: Update, job):
+    user_id, message_id = job["user_id"], job["message_id"]
     notification_message = await update.message.reply_text("⌛", reply_to_message_id=message_id)
+    job["notification_message_id"] = notification_message.message_id
+    # a job resumed after a restart has its completion, and has paid for it, so it is only rendered
     try:
-        response, n_used_tokens = await openai_utils.process_prompt(prompt)
+        pptx_file, pptx_title = await pipeline.run_presentation(
+            job, on_answer=lambda n_used_tokens: charge_tokens("presentation", user_id, n_used_tokens))
     except OverflowError:
         await notification_message.delete()
         await update.message.reply_text(text="Tizim hozirda haddan tashqari band. Iltimos, keyinroq qayta urinib ko'ring. 😊",
@@ -405,12 +540,15 @@ async def auto_generate_presentation(update: Update, context: CallbackContext, u
         await update.message.reply_text(text="Taqdimotingiz juda katta. Iltimos, qayta urinib ko'ring. 😊",
                                         reply_to_message_id=message_id)
         return END
-    available_tokens = db.get_user_attribute(user_id, "n_available_tokens")
-    db.set_user_attribute(user_id, "n_available_tokens", available_tokens - n_used_tokens)
-    used_tokens = db.get_user_attribute(user_id, "n_used_tokens")
-    db.set_user_attribute(user_id, "n_used_tokens", n_used_tokens + used_tokens)
-    pptx_bytes, pptx_title = await presentation.generate_ppt(response, template_choice)
-    await update.message.reply_document(document=pptx_bytes, filename=pptx_title)
+    except TimeoutError:
+        await notification_message.delete()
+        await update.message.reply_text(text="Javob kutish vaqti tugadi. Iltimos, keyinroq qayta urinib ko'ring. 😊",
+                                        reply_to_message_id=message_id)
+        return END
+    job["delivered"] = True
+    with pptx_file, metrics.STAGE_SECONDS.labels("upload").time(), metrics.FAILURES.labels("upload").count_exceptions(), \
+            tracing.span("upload"):
+        await update.message.reply_document(document=pptx_file, filename=pptx_title)
     await notification_message.delete()
 
 
@@ -427,16 +565,28 @@ async def presentation_save_input(update: Update, context: CallbackContext):
     template_choice = user_data[TEMPLATE_CHOICE].replace("template_", "")
     type_choice = user_data[PRESENTATION_TYPE_CHOICE].replace("type_", "")
     count_slide_choice = user_data[COUNT_SLIDE_CHOICE].replace("slide_count_", "")
-    prompt = await presentation.generate_ppt_prompt(language_choice, type_choice, count_slide_choice, topic_choice)
+    trace = tracing.Trace("presentation", user_id)
     if user_mode == "auto":
+        try:
+            with trace.activate(), tracing.span("prompt", language=language_choice, template=template_choice,
+                                                 type=type_choice, slides=count_slide_choice):
+                job = await pipeline.presentation_job(language_choice, type_choice, count_slide_choice, topic_choice,
+                                                      template_choice)
+        except ValueError:
+            await update.message.reply_text("Taqdimotingiz juda katta. Iltimos, qisqaroq mavzu kiriting. 😊")
+            return INPUT_TOPIC
         available_tokens = db.get_user_attribute(user_id, "n_available_tokens")
-        if available_tokens > 0:
-            loop = asyncio.get_event_loop()
-            loop.create_task(auto_generate_presentation(update, context, user_id, message_id, prompt, template_choice))
+        if available_tokens >= job["expected_tokens"]:
+            job.update({"kind": "presentation", "user_id": user_id, "chat_id": update.effective_chat.id,
+                        "message_id": message_id})
+            spawn_generation("presentation", generate_presentation(update, job), trace, job)
         else:
-            await update.message.reply_text("Tokenlaringiz yetarli emas."
+            await update.message.reply_text(f"Tokenlaringiz yetarli emas. Taqdimot uchun taxminan {job['expected_tokens']} token kerak."
                                             "\n\Iltimos, balansingizni to'ldiring. Balansni to'ldirish uchun - /balansni_toldirish buyrug'ini kiriting.")
     else:
+        with trace.activate(), tracing.span("prompt", language=language_choice, template=template_choice,
+                                             type=type_choice, slides=count_slide_choice):
+            prompt = await presentation.generate_ppt_prompt(language_choice, type_choice, count_slide_choice, topic_choice)
         try:
             await update.message.reply_text(text="`" + prompt + "`", parse_mode=ParseMode.MARKDOWN_V2)
         except telegram.error.BadRequest:
@@ -453,10 +603,126 @@ async def presentation_save_input(update: Update, context: CallbackContext):
     return END
 
 
-async def auto_generate_abstract(update: Update, context: CallbackContext, user_id, message_id, prompt):
+async def presentation_save_batch_text(update: Update, context: CallbackContext):
+    """/batch followed by one topic per line. Without the command a message of several lines
+    is one topic, the later lines clarifying the first."""
+    await register_user_if_not_exists(update, context, update.message.from_user)
+    command_and_topics = update.message.text.split(maxsplit=1)
+    topics = batch.parse_topics(command_and_topics[1]) if len(command_and_topics) > 1 else []
+    if not topics:
+        await update.message.reply_text("/batch buyrug'idan keyin har bir mavzuni yangi qatorga yozing. 😊")
+        return INPUT_TOPIC
+    return await start_presentation_batch(update, context, topics)
+
+
+async def presentation_save_batch_file(update: Update, context: CallbackContext):
+    await register_user_if_not_exists(update, context, update.message.from_user)
+    document = update.message.document
+    if document.file_size and document.file_size > BATCH_FILE_MAX_BYTES:
+        await update.message.reply_text("Fayl juda katta. Iltimos, faqat mavzular ro'yxatini yuboring. 😊")
+        return INPUT_TOPIC
+    topics_file = await document.get_file()
+    data = await topics_file.download_as_bytearray()
+    topics = batch.read_topics(bytes(data), document.file_name or "")
+    if not topics:
+        await update.message.reply_text("Faylda mavzu topilmadi. Har bir mavzuni alohida qatorga yozing. 😊")
+        return INPUT_TOPIC
+    return await start_presentation_batch(update, context, topics)
+
+
+async def start_presentation_batch(update: Update, context: CallbackContext, topics):
+    user_data = context.user_data
+    user_id = update.message.from_user.id
+    message_id = update.message.message_id
+    if len(topics) > config.batch_max_topics:
+        await update.message.reply_text(f"Bir martada ko'pi bilan {config.batch_max_topics} ta mavzu yuborish mumkin. "
+                                        "Iltimos, ro'yxatni qisqartiring. 😊")
+        return INPUT_TOPIC
+    if db.get_user_attribute(user_id, "current_chat_mode") != "auto":
+        await update.message.reply_text("Bir nechta mavzu bo'yicha taqdimotlar faqat avtomatik rejimda yaratiladi. "
+                                        "Rejimni tanlash uchun - /mode. 😊")
+        return INPUT_TOPIC
+    language_choice = user_data[PRESENTATION_LANGUAGE_CHOICE].replace("language_", "")
+    template_choice = user_data[TEMPLATE_CHOICE].replace("template_", "")
+    type_choice = user_data[PRESENTATION_TYPE_CHOICE].replace("type_", "")
+    count_slide_choice = user_data[COUNT_SLIDE_CHOICE].replace("slide_count_", "")
+    trace = tracing.Trace("batch", user_id)
+    with trace.activate(), tracing.span("prompt", language=language_choice, template=template_choice,
+                                         type=type_choice, slides=count_slide_choice, topics=len(topics)):
+        decks, too_long = await batch.prepare(topics, language_choice, type_choice, count_slide_choice)
+    if not decks:
+        await update.message.reply_text("Mavzularingiz juda katta. Iltimos, qisqaroq mavzular kiriting. 😊")
+        return INPUT_TOPIC
+    if too_long:
+        await update.message.reply_text("Quyidagi mavzular juda katta, ular uchun taqdimot yaratilmaydi:\n"
+                                        + "\n".join(f"• {topic}" for topic in too_long))
+    # the whole batch is paid for up front, what is not used is returned when it is done
+    expected_tokens = sum(deck.expected_tokens for deck in decks)
+    if not db.reserve_tokens(user_id, expected_tokens):
+        await update.message.reply_text(f"Tokenlaringiz yetarli emas. {len(decks)} ta taqdimot uchun taxminan {expected_tokens} token kerak."
+                                        "\nIltimos, balansingizni to'ldiring. Balansni to'ldirish uchun - /balansni_toldirish buyrug'ini kiriting.")
+        return END
+    job = {"kind": "batch", "user_id": user_id, "chat_id": update.effective_chat.id, "message_id": message_id,
+           "type_choice": type_choice, "template_choice": template_choice, "reserved_tokens": expected_tokens,
+           "decks": [deck.state() for deck in decks]}
+    spawn_generation("batch", generate_presentation_batch(update, job), trace, job)
+    return END
+
+
+async def generate_presentation_batch(update: Update, job):
+    user_id, message_id = job["user_id"], job["message_id"]
+    decks = [batch.Job(**state) for state in job["decks"]]
+    notification_message = await update.message.reply_text(f"⌛ {len(decks)} ta taqdimot tayyorlanmoqda",
+                                                            reply_to_message_id=message_id)
+    job["notification_message_id"] = notification_message.message_id
+
+    def keep_answer(deck):
+        job["decks"][decks.index(deck)] = deck.state()
+
+    # cancelled only by a shutdown, the reservation then stays with the persisted job
+    await batch.generate(decks, job["type_choice"], job["template_choice"], llm_concurrency=config.batch_llm_concurrency,
+                         render_concurrency=config.batch_render_concurrency, on_answer=keep_answer)
+    if not job.get("settled"):
+        db.settle_tokens(user_id, job["reserved_tokens"], sum(deck.n_used_tokens for deck in decks))
+        job["settled"] = True
+
+    done = [deck for deck in decks if deck.file is not None]
+    usage.record("batch", user_id, tokens=sum(deck.n_used_tokens for deck in decks), documents=len(done))
+    job["delivered"] = True
+    try:
+        with metrics.STAGE_SECONDS.labels("upload").time(), metrics.FAILURES.labels("upload").count_exceptions(), \
+                tracing.span("upload", decks=len(done)):
+            if len(done) == 1:
+                await update.message.reply_document(document=done[0].file, filename=done[0].title,
+                                                    reply_to_message_id=message_id)
+            elif len(done) <= batch.MEDIA_GROUP_SIZE:
+                await update.message.reply_media_group(
+                    [InputMediaDocument(media=deck.file, filename=deck.title) for deck in done],
+                    reply_to_message_id=message_id)
+            else:
+                for part, archive in enumerate(batch.archives(decks, config.batch_archive_bytes), 1):
+                    with archive:
+                        await update.message.reply_document(document=archive, filename=f"taqdimotlar_{part}.zip",
+                                                            reply_to_message_id=message_id)
+    finally:
+        for deck in done:
+            deck.file.close()
+    failed = [deck.topic for deck in decks if deck.file is None]
+    if failed:
+        await update.message.reply_text("Quyidagi mavzular bo'yicha taqdimot yaratib bo'lmadi. Iltimos, qayta urinib ko'ring:\n"
+                                        + "\n".join(f"• {topic}" for topic in failed),
+                                        reply_to_message_id=message_id)
+    await notification_message.delete()
+
+
+async def auto_generate_abstract(update: Update, job):
+    user_id, message_id = job["user_id"], job["message_id"]
     notification_message = await update.message.reply_text("⌛", reply_to_message_id=message_id)
+    job["notification_message_id"] = notification_message.message_id
+    # a job resumed after a restart has its completion, and has paid for it, so it is only rendered
     try:
-        response, n_used_tokens = await openai_utils.process_prompt(prompt)
+        docx_file, docx_title = await pipeline.run_abstract(
+            job, on_answer=lambda n_used_tokens: charge_tokens("abstract", user_id, n_used_tokens))
     except OverflowError:
         await notification_message.delete()
         await update.message.reply_text(text="Tizim hozirda haddan tashqari band. Iltimos, keyinroq qayta urinib ko'ring. 😊",
@@ -472,12 +738,15 @@ async def auto_generate_abstract(update: Update, context: CallbackContext, user_
         await update.message.reply_text(text="Tezisingiz juda katta. Iltimos, qayta urinib ko'ring😊",
                                         reply_to_message_id=message_id)
         return END
-    available_tokens = db.get_user_attribute(user_id, "n_available_tokens")
-    db.set_user_attribute(user_id, "n_available_tokens", available_tokens - n_used_tokens)
-    used_tokens = db.get_user_attribute(user_id, "n_used_tokens")
-    db.set_user_attribute(user_id, "n_used_tokens", n_used_tokens + used_tokens)
-    docx_bytes, docx_title = await abstract.generate_docx(response)
-    await update.message.reply_document(document=docx_bytes, filename=docx_title)
+    except TimeoutError:
+        await notification_message.delete()
+        await update.message.reply_text(text="Javob kutish vaqti tugadi. Iltimos, keyinroq qayta urinib ko'ring. 😊",
+                                        reply_to_message_id=message_id)
+        return END
+    job["delivered"] = True
+    with docx_file, metrics.STAGE_SECONDS.labels("upload").time(), metrics.FAILURES.labels("upload").count_exceptions(), \
+            tracing.span("upload"):
+        await update.message.reply_document(document=docx_file, filename=docx_title)
     await notification_message.delete()
 
 
@@ -492,12 +761,16 @@ async def abstract_save_input(update: Update, context: CallbackContext):
     user_mode = db.get_user_attribute(user_id, "current_chat_mode")
     language_choice = user_data[ABSTRACT_LANGUAGE_CHOICE].replace("language_", "")
     type_choice = user_data[ABSTRACT_TYPE_CHOICE].replace("type_", "")
-    prompt = await abstract.generate_docx_prompt(language_choice, type_choice, topic_choice)
+    trace = tracing.Trace("abstract", user_id)
+    with trace.activate(), tracing.span("prompt", language=language_choice, type=type_choice):
+        job = await pipeline.abstract_job(language_choice, type_choice, topic_choice)
+    prompt = job["prompt"]
     if user_mode == "auto":
         available_tokens = db.get_user_attribute(user_id, "n_available_tokens")
         if available_tokens > 0:
-            loop = asyncio.get_event_loop()
-            loop.create_task(auto_generate_abstract(update, context, user_id, message_id, prompt))
+            job.update({"kind": "abstract", "user_id": user_id, "chat_id": update.effective_chat.id,
+                        "message_id": message_id})
+            spawn_generation("abstract", auto_generate_abstract(update, job), trace, job)
         else:
             await update.message.reply_text("Tokenlaringiz yetarli emas😊")
     else:
@@ -526,8 +799,11 @@ async def presentation_prompt_callback(update: Update, context: CallbackContext)
     user_data = context.user_data
     template_choice = user_data[TEMPLATE_CHOICE].replace("template_", "")
     try:
-        pptx_bytes, pptx_title = await presentation.generate_ppt(api_response, template_choice)
-        await update.message.reply_document(document=pptx_bytes, filename=pptx_title)
+        pptx_file, pptx_title = await presentation.generate_ppt(api_response, template_choice)
+        with pptx_file, metrics.STAGE_SECONDS.labels("upload").time(), metrics.FAILURES.labels("upload").count_exceptions(), \
+                tracing.span("upload"):
+            await update.message.reply_document(document=pptx_file, filename=pptx_title)
+        usage.record("manual_presentation", update.message.from_user.id)
     except IndexError:
         await update.message.reply_text("Kiritilgan maʼlumotlarni tekshiring va qayta urinib koʻring😊")
         return INPUT_PROMPT
@@ -541,8 +817,11 @@ async def abstract_prompt_callback(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     api_response = update.message.text
     try:
-        docx_bytes, docx_title = await abstract.generate_docx(api_response)
-        await update.message.reply_document(document=docx_bytes, filename=docx_title)
+        docx_file, docx_title = await abstract.generate_docx(api_response)
+        with docx_file, metrics.STAGE_SECONDS.labels("upload").time(), metrics.FAILURES.labels("upload").count_exceptions(), \
+                tracing.span("upload"):
+            await update.message.reply_document(document=docx_file, filename=docx_title)
+        usage.record("manual_abstract", update.message.from_user.id)
     except IndexError:
         await update.message.reply_text("Kiritilgan maʼlumotlarni tekshiring va qayta urinib koʻring😊")
         return INPUT_PROMPT
@@ -556,6 +835,14 @@ async def end_second_level(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     return END
 
 
+# generation coroutines by job kind, to resume persisted jobs with
+GENERATIONS = {
+    "presentation": generate_presentation,
+    "abstract": auto_generate_abstract,
+    "batch": generate_presentation_batch,
+}
+
+
 async def show_balance_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
 
@@ -699,6 +986,88 @@ async def handle_token_amount_selection(update: Update, context: CallbackContext
         # Message might have already been deleted or is inaccessible
         pass
 
+async def stats_handle(update: Update, context: CallbackContext):
+    hours = int(context.args[0]) if context.args and context.args[0].isdigit() else 24
+    stages = await asyncio.to_thread(db.get_stage_percentiles, datetime.utcnow() - timedelta(hours=hours))
+    if not stages:
+        await update.message.reply_text(f"So'nggi {hours} soatda ma'lumot yo'q.")
+        return
+
+    rows = [f"{'stage':<10}{'count':>7}{'p50':>8}{'p95':>8}{'p99':>8}"]
+    for stage in stages:
+        p50, p95, p99 = stage["percentiles"]
+        rows.append(f"{stage['_id']:<10}{stage['count']:>7}{p50:>8.2f}{p95:>8.2f}{p99:>8.2f}")
+    text = f"<b>So'nggi {hours} soat, soniyalarda:</b>\n<pre>" + html.escape("\n".join(rows)) + "</pre>"
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+
+async def usage_handle(update: Update, context: CallbackContext):
+    days = min(max(int(context.args[0]), 1), 90) if context.args and context.args[0].isdigit() else 7
+    rollups = await asyncio.to_thread(db.get_daily_usage, days)
+    if not rollups:
+        await update.message.reply_text(f"So'nggi {days} kunda ma'lumot yo'q.")
+        return
+
+    by_day, by_kind, active_users = {}, {}, set()
+    for rollup in rollups:
+        day = by_day.setdefault(rollup["_id"]["bucket"].date(), {"users": set(), "events": 0, "documents": 0, "tokens": 0})
+        kind = by_kind.setdefault(rollup["_id"]["kind"], {"events": 0, "documents": 0, "tokens": 0})
+        for totals in (day, kind):
+            for key in ("events", "documents", "tokens"):
+                totals[key] += rollup[key]
+        day["users"].update(rollup["users"])
+        active_users.update(rollup["users"])
+
+    rows = [f"{'day':<11}{'users':>7}{'jobs':>7}{'docs':>7}{'tokens':>10}"]
+    for day, totals in by_day.items():
+        rows.append(f"{day.isoformat():<11}{len(totals['users']):>7}{totals['events']:>7}{totals['documents']:>7}"
+                    f"{totals['tokens']:>10}")
+    rows.append("")
+    rows.append(f"{'kind':<20}{'jobs':>7}{'docs':>7}{'tokens':>10}")
+    for kind, totals in sorted(by_kind.items()):
+        rows.append(f"{kind:<20}{totals['events']:>7}{totals['documents']:>7}{totals['tokens']:>10}")
+    text = (f"<b>So'nggi {days} kun (UTC), faol foydalanuvchilar: {len(active_users)}</b>\n<pre>"
+            + html.escape("\n".join(rows)) + "</pre>")
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+
+PROFILE_USAGE = """<b>Profil:</b>
+/profile cpu [soniya] – cProfile, event loop
+/profile sample [soniya] – barcha threadlar, sampling
+/profile mem start – tracemalloc yoqish
+/profile mem snapshot – snapshot va oldingisi bilan farq
+/profile mem stop – tracemalloc o'chirish"""
+
+
+async def profile_handle(update: Update, context: CallbackContext):
+    args = context.args or []
+    command = args[0] if args else None
+    seconds = int(args[1]) if len(args) > 1 and args[1].isdigit() else 30
+    try:
+        if command in ("cpu", "sample"):
+            await update.message.reply_text(f"⏱ {seconds} soniya profil olinmoqda...")
+            files = await (profiling.cprofile if command == "cpu" else profiling.sample)(seconds)
+        elif command == "mem" and len(args) > 1 and args[1] == "start":
+            profiling.start_tracing()
+            await update.message.reply_text("tracemalloc yoqildi.")
+            return
+        elif command == "mem" and len(args) > 1 and args[1] == "stop":
+            profiling.stop_tracing()
+            await update.message.reply_text("tracemalloc o'chirildi.")
+            return
+        elif command == "mem" and len(args) > 1 and args[1] == "snapshot":
+            files = await profiling.snapshot()
+        else:
+            await update.message.reply_text(PROFILE_USAGE, parse_mode=ParseMode.HTML)
+            return
+    except (ValueError, RuntimeError) as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+
+    for filename, data in files:
+        await update.message.reply_document(document=data, filename=filename, rate_limit_args=rate_limiter.REPORT)
+
+
 async def edited_message_handle(update: Update, context: CallbackContext):
     text = "🥲 Afsuski, xabar <b>editing</b> qo'llab quvvatlanmadi"
     await update.edited_message.reply_text(text, parse_mode=ParseMode.HTML)
@@ -722,22 +1091,33 @@ async def error_handle(update: object, context: ContextTypes.DEFAULT_TYPE) -> No
         # split text into multiple messages due to 4096 character limit
         for message_chunk in split_text_into_chunks(message, 4096):
             try:
-                await context.bot.send_message(update.effective_chat.id, message_chunk, parse_mode=ParseMode.HTML)
+                await context.bot.send_message(update.effective_chat.id, message_chunk, parse_mode=ParseMode.HTML,
+                                               rate_limit_args=rate_limiter.REPORT)
             except telegram.error.BadRequest:
                 # answer has invalid characters, so we send it without parse_mode
-                await context.bot.send_message(update.effective_chat.id, message_chunk)
+                await context.bot.send_message(update.effective_chat.id, message_chunk,
+                                               rate_limit_args=rate_limiter.REPORT)
     except Exception:
-        await context.bot.send_message(update.effective_chat.id, "Some error in error handler")
+        await context.bot.send_message(update.effective_chat.id, "Some error in error handler",
+                                       rate_limit_args=rate_limiter.REPORT)
 
 
 def run_bot() -> None:
+    global sessions
+    startup.mark("imports")
+
     application = (
         ApplicationBuilder()
         .token(config.telegram_token)
+        .base_url(config.telegram_base_url)
         .read_timeout(30)
         .write_timeout(20)
         .concurrent_updates(True)
+        .rate_limiter(rate_limiter.PriorityRateLimiter(**config.telegram_rate_limits,
+                                                       report_chat_ids=[config.admin_chat_id]))
         .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
@@ -768,7 +1148,12 @@ def run_bot() -> None:
                 CallbackQueryHandler(presentation_slide_count_callback, pattern="^page_slide_count_"),
                 CallbackQueryHandler(presentation_topic_callback, pattern="^slide_count_"),
                              ],
-            INPUT_TOPIC: [MessageHandler(filters.TEXT & ~filters.COMMAND, presentation_save_input)],
+            INPUT_TOPIC: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, presentation_save_input),
+                CommandHandler("batch", presentation_save_batch_text, filters=user_filter),
+                MessageHandler(filters.Document.FileExtension("txt") | filters.Document.FileExtension("csv"),
+                               presentation_save_batch_file),
+            ],
             INPUT_PROMPT: [MessageHandler(filters.TEXT & ~filters.COMMAND, presentation_prompt_callback)],
         },
         fallbacks=[
@@ -821,7 +1206,14 @@ def run_bot() -> None:
     )
     application.add_handler(menu_conv_handler)
 
+    sessions = session_store.SessionStore(application, menu_conv_handler, db, idle_ttl=config.session_idle_ttl,
+                                          max_sessions=config.session_max_entries, spill=config.session_spill)
+    application.add_handler(sessions.handler(), group=-1)
+
     application.add_handler(CommandHandler("balance", show_balance_handle, filters=user_filter))
+    application.add_handler(CommandHandler("stats", stats_handle, filters=filters.Chat(chat_id=config.admin_chat_id)))
+    application.add_handler(CommandHandler("usage", usage_handle, filters=filters.Chat(chat_id=config.admin_chat_id)))
+    application.add_handler(CommandHandler("profile", profile_handle, filters=filters.Chat(chat_id=config.admin_chat_id)))
 # Add command handlers to the application
     application.add_handler(CommandHandler("balansni_toldirish", balansni_toldirish))
     
@@ -842,8 +1234,13 @@ def run_bot() -> None:
     
     application.add_error_handler(error_handle)
 
+    metrics.start_server(config.metrics_port, config.metrics_address)
+    startup.mark("build")
     application.run_polling()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # one line per Bot API request otherwise
+    logging.getLogger("httpx").setLevel(logging.WARNING)
     run_bot()
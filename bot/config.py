@@ -1,15 +1,18 @@
+import os
 from pathlib import Path
 
 import dotenv
 
 import yaml
 
+# the C loader when PyYAML was built with libyaml
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
-config_dir = Path(__file__).parent.parent.resolve() / "config"
+config_dir = Path(os.environ.get("PRESENTO_CONFIG_DIR", Path(__file__).parent.parent.resolve() / "config"))
 
 # load yaml config
 with open(config_dir / "config.yml", 'r') as f:
-    config_yaml = yaml.safe_load(f)
+    config_yaml = yaml.load(f, Loader=SafeLoader)
 
 # load .env config
 config_env = dotenv.dotenv_values(config_dir / "config.env")
@@ -20,8 +23,54 @@ openai_api_key = config_yaml["openai_api_key"]
 admin_chat_id = config_yaml["admin_chat_id"]
 provider_token = config_yaml["provider_token"]
 allowed_telegram_usernames = config_yaml["allowed_telegram_usernames"]
-mongodb_uri = f"mongodb://mongo:{config_env['MONGODB_PORT']}"
+telegram_base_url = config_yaml.get("telegram_base_url", "https://api.telegram.org/bot")
+bing_base_url = config_yaml.get("bing_base_url", "https://www.bing.com")
+# curated images indexed with bot/ai_generator/image_scrapper/library.py, used when Bing has none
+image_library_dir = config_yaml.get("image_library_dir", "image_library")
+image_library_first = config_yaml.get("image_library_first", True)
+# image links found for a query are shared by the replicas for this long
+image_results_ttl = config_yaml.get("image_results_ttl", 7 * 24 * 60 * 60)
+# OpenAI-compatible completion backends, see llm_router.Router for the routing options
+llm_backends = config_yaml.get("llm_backends") or [
+    {"name": "openai", "api_base": "https://api.openai.com/v1", "model": "gpt-3.5-turbo"},
+]
+for backend in llm_backends:
+    backend.setdefault("api_key", openai_api_key)
+llm_routing = config_yaml.get("llm_routing", {})
+# follow-up completions continuing an answer cut off by max_tokens
+llm_max_continuations = config_yaml.get("llm_max_continuations", 2)
+job_deadline_seconds = config_yaml.get("job_deadline_seconds", 150)
+job_stage_shares = config_yaml.get("job_stage_shares", {})
+batch_max_topics = config_yaml.get("batch_max_topics", 20)
+batch_llm_concurrency = config_yaml.get("batch_llm_concurrency", 2)
+batch_render_concurrency = config_yaml.get("batch_render_concurrency", 1)
+batch_archive_bytes = config_yaml.get("batch_archive_bytes", 45 * 1024 * 1024)
+# seconds a shutdown waits for generations in flight, the rest are persisted and resumed on start
+shutdown_drain_seconds = config_yaml.get("shutdown_drain_seconds", 45)
+render_spool_bytes = config_yaml.get("render_spool_bytes", 2 * 1024 * 1024)
+pptx_compress_level = config_yaml.get("pptx_compress_level", 6)
+image_cache_bytes = config_yaml.get("image_cache_bytes", 64 * 1024 * 1024)
+# channels a user has to join before using the bot
+required_channels = config_yaml.get("required_channels", ["-1002109445838"])
+membership_ttl = config_yaml.get("membership_ttl", 600)
+membership_negative_ttl = config_yaml.get("membership_negative_ttl", 15)
+# conversations idle this long are ended and their user_data/chat_data dropped
+session_idle_ttl = config_yaml.get("session_idle_ttl", 1800)
+session_max_entries = config_yaml.get("session_max_entries", 10000)
+session_spill = config_yaml.get("session_spill", True)
+# PriorityRateLimiter options for outgoing Bot API requests
+telegram_rate_limits = config_yaml.get("telegram_rate_limits", {})
+metrics_port = config_yaml.get("metrics_port", 9100)
+metrics_address = config_yaml.get("metrics_address", "127.0.0.1")
+trace_collection_bytes = config_yaml.get("trace_collection_bytes", 64 * 1024 * 1024)
+# raw usage events are kept this long, the hourly and daily rollups for good
+usage_event_days = config_yaml.get("usage_event_days", 90)
+usage_rollup_interval = config_yaml.get("usage_rollup_interval", 300)
+abstract_two_phase = config_yaml.get("abstract_two_phase", True)
+abstract_section_concurrency = config_yaml.get("abstract_section_concurrency", 4)
+mongodb_uri = config_env.get("MONGODB_URI") or f"mongodb://mongo:{config_env['MONGODB_PORT']}"
+mongodb_database = config_env.get("MONGODB_DATABASE") or "chatgpt_telegram_bot"
 
 # chat_modes
 with open(config_dir / "chat_modes.yml", 'r') as f:
-    chat_modes = yaml.safe_load(f)
+    chat_modes = yaml.load(f, Loader=SafeLoader)
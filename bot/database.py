@@ -1,4 +1,5 @@
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 from typing import Any
 
 import config
@@ -8,11 +9,42 @@ import pymongo
 
 class Database:
     def __init__(self):
-        self.client = pymongo.MongoClient(config.mongodb_uri)
-        self.db = self.client["chatgpt_telegram_bot"]
+        # connects on the first operation, which is create_collections after the bot polls
+        self.client = pymongo.MongoClient(config.mongodb_uri, connect=False)
+        self.db = self.client[config.mongodb_database]
 
         self.user_collection = self.db["user"]
         self.dialog_collection = self.db["dialog"]
+        self.trace_collection = self.db["trace"]
+        self.session_collection = self.db["session"]
+        self.job_collection = self.db["job"]
+        self.usage_collection = self.db["usage_event"]
+        self.image_host_collection = self.db["image_host"]
+        self.image_results_collection = self.db["image_results"]
+        # rollups are computed and read on a secondary when there is one, away from the hot path
+        self.analytics_db = self.client.get_database(config.mongodb_database,
+                                                     read_preference=pymongo.ReadPreference.SECONDARY_PREFERRED)
+
+    def create_collections(self):
+        if "trace" not in self.db.list_collection_names():
+            try:
+                self.db.create_collection("trace", capped=True, size=config.trace_collection_bytes)
+            except pymongo.errors.CollectionInvalid:
+                pass  # created by another replica meanwhile
+        self.trace_collection.create_index("started_at")
+        # spilled sessions nobody came back to
+        self.session_collection.create_index("spilled_at", expireAfterSeconds=config.session_idle_ttl)
+        # generation jobs persisted on shutdown are not resumed after a day
+        self.job_collection.create_index("saved_at", expireAfterSeconds=24 * 60 * 60)
+        # raw events are only read by the rollups, which are kept
+        self.usage_collection.create_index("at", expireAfterSeconds=config.usage_event_days * 24 * 60 * 60)
+        self.usage_collection.create_index([("user_id", pymongo.ASCENDING), ("at", pymongo.ASCENDING)])
+        for rollup in ("usage_hourly", "usage_daily"):
+            self.db[rollup].create_index("_id.bucket")
+        # hosts no image was downloaded from for a month
+        self.image_host_collection.create_index("updated_at", expireAfterSeconds=30 * 24 * 60 * 60)
+        # results pages are searched again after this, links that came and went since are picked up
+        self.image_results_collection.create_index("searched_at", expireAfterSeconds=config.image_results_ttl)
 
     def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
         if self.user_collection.count_documents({"_id": user_id}) > 0:
@@ -63,3 +95,149 @@ class Database:
     def set_user_attribute(self, user_id: int, key: str, value: Any):
         self.check_if_user_exists(user_id, raise_exception=True)
         self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+
+    def reserve_tokens(self, user_id: int, n_tokens: int):
+        """Takes n_tokens off the balance if it has them, returns whether it did."""
+        user = self.user_collection.find_one_and_update(
+            {"_id": user_id, "n_available_tokens": {"$gte": n_tokens}},
+            {"$inc": {"n_available_tokens": -n_tokens}},
+        )
+        return user is not None
+
+    def settle_tokens(self, user_id: int, n_reserved_tokens: int, n_used_tokens: int):
+        """Returns what was reserved but not used and counts what was."""
+        self.user_collection.update_one({"_id": user_id}, {"$inc": {
+            "n_available_tokens": n_reserved_tokens - n_used_tokens,
+            "n_used_tokens": n_used_tokens,
+        }})
+
+    def save_jobs(self, jobs):
+        self.job_collection.insert_many([{**job, "saved_at": datetime.utcnow()} for job in jobs])
+
+    def pop_jobs(self):
+        """Claims the persisted jobs one at a time, so replicas starting together never share one."""
+        jobs = []
+        while True:
+            job = self.job_collection.find_one_and_delete({})
+            if job is None:
+                return jobs
+            jobs.append(job)
+
+    @staticmethod
+    def session_id(key):
+        # arrays cannot be _id values
+        chat_id, user_id = key
+        return {"chat_id": chat_id, "user_id": user_id}
+
+    def spill_sessions(self, sessions):
+        self.session_collection.bulk_write([
+            pymongo.ReplaceOne({"_id": self.session_id(key)}, {**session, "spilled_at": datetime.utcnow()},
+                               upsert=True)
+            for key, session in sessions
+        ], ordered=False)
+
+    def restore_session(self, key):
+        return self.session_collection.find_one_and_delete({"_id": self.session_id(key)})
+
+    def count_spilled_sessions(self):
+        return self.session_collection.estimated_document_count()
+
+    def add_traces(self, traces):
+        self.trace_collection.insert_many(traces, ordered=False)
+
+    def get_stage_percentiles(self, since: datetime):
+        return list(self.trace_collection.aggregate([
+            {"$match": {"started_at": {"$gte": since}}},
+            {"$unwind": "$spans"},
+            {"$group": {
+                "_id": "$spans.name",
+                "count": {"$sum": 1},
+                "percentiles": {"$percentile": {
+                    "input": "$spans.duration",
+                    "p": [0.5, 0.95, 0.99],
+                    "method": "approximate",
+                }},
+            }},
+            {"$sort": {"_id": 1}},
+        ]))
+
+    def add_usage_events(self, events):
+        self.usage_collection.insert_many(events, ordered=False)
+
+    def roll_up_usage(self, since: datetime):
+        """Recomputes the hourly rollups from the events since the hour of since, then the daily
+        ones from the hourly rollups since its day. Buckets are replaced whole, so running it
+        again or on several replicas gives the same rollups."""
+        hour = since.replace(minute=0, second=0, microsecond=0)
+        self.analytics_db["usage_event"].aggregate([
+            {"$match": {"at": {"$gte": hour}}},
+            {"$group": {
+                "_id": {"bucket": {"$dateTrunc": {"date": "$at", "unit": "hour"}}, "kind": "$kind"},
+                "events": {"$sum": 1},
+                "tokens": {"$sum": "$tokens"},
+                "documents": {"$sum": "$documents"},
+                "users": {"$addToSet": "$user_id"},
+            }},
+            {"$set": {"n_users": {"$size": "$users"}}},
+            {"$merge": {"into": "usage_hourly", "whenMatched": "replace"}},
+        ])
+        day = hour.replace(hour=0)
+        self.analytics_db["usage_hourly"].aggregate([
+            {"$match": {"_id.bucket": {"$gte": day}}},
+            {"$group": {
+                "_id": {"bucket": {"$dateTrunc": {"date": "$_id.bucket", "unit": "day"}}, "kind": "$_id.kind"},
+                "events": {"$sum": "$events"},
+                "tokens": {"$sum": "$tokens"},
+                "documents": {"$sum": "$documents"},
+                "users": {"$push": "$users"},
+            }},
+            {"$set": {"users": {"$reduce": {
+                "input": "$users", "initialValue": [], "in": {"$setUnion": ["$$value", "$$this"]},
+            }}}},
+            {"$set": {"n_users": {"$size": "$users"}}},
+            {"$merge": {"into": "usage_daily", "whenMatched": "replace"}},
+        ])
+
+    def get_daily_usage(self, days: int):
+        """Daily rollups of the last days, today included, oldest first."""
+        since = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+        return list(self.analytics_db["usage_daily"].find({"_id.bucket": {"$gte": since}}).sort("_id.bucket", 1))
+
+    def add_image_hosts(self, records, half_life: float):
+        """Decays the shared counts of each host to now and adds the new observations to them."""
+        now = time.time()
+        # (now - updated) / half_life half-lives have passed since the last update
+        decay = {"$pow": [0.5, {"$divide": [
+            {"$max": [0, {"$subtract": [now, {"$ifNull": ["$updated", now]}]}]}, half_life,
+        ]}]}
+        self.image_host_collection.bulk_write([
+            pymongo.UpdateOne({"_id": record["_id"]}, [{"$set": {
+                **{field: {"$add": [{"$multiply": [{"$ifNull": [f"${field}", 0]}, decay]}, record[field]]}
+                   for field in ("attempts", "errors", "invalid", "seconds")},
+                "updated": now,
+                "updated_at": datetime.utcnow(),
+            }}], upsert=True)
+            for record in records
+        ], ordered=False)
+
+    def get_image_hosts(self):
+        return list(self.image_host_collection.find({}, {"updated_at": 0}))
+
+    @staticmethod
+    def image_results_id(key):
+        # arrays cannot be _id values
+        query, filter, adult = key
+        return {"query": query, "filter": filter, "adult": adult}
+
+    def get_image_results(self, key):
+        results = self.image_results_collection.find_one({"_id": self.image_results_id(key)}, {"links": 1})
+        return results["links"] if results else None
+
+    def put_image_results(self, key, links, searched: bool):
+        """Stores the links of a query with their download outcomes. The expiry only restarts
+        when they come from a fresh search, not when known links are tried again."""
+        now = {"searched_at": datetime.utcnow()}
+        self.image_results_collection.update_one({"_id": self.image_results_id(key)}, {
+            "$set": {"links": links, **(now if searched else {})},
+            **({} if searched else {"$setOnInsert": now}),
+        }, upsert=True)
@@ -0,0 +1,162 @@
+"""Presentations and abstracts without Telegram, from the command line or a local HTTP API.
+
+Auto mode takes a topic, manual mode a tagged reply pasted from another chat (a file or -
+for stdin). The files are written to --output:
+
+    python bot/headless.py presentation --topic "Mount Everest" --language English --type Ilmiy --slides 8 --template Floral
+    python bot/headless.py presentation --reply reply.txt --template Floral
+    python bot/headless.py abstract --topic "Mount Everest" --language Uzbek --type Ilmiy
+    python bot/headless.py serve --port 8090
+
+The API takes the same options as JSON and answers with the file, or {"error": ...}:
+
+    curl -o deck.pptx -d '{"topic": "Mount Everest", "language": "English", "type": "Ilmiy",
+                           "slides": 8, "template": "Floral"}' http://127.0.0.1:8090/presentation
+    curl -o abstract.docx -d '{"reply": "..."}' http://127.0.0.1:8090/abstract
+"""
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import sys
+import urllib.parse
+from pathlib import Path
+
+from aiohttp import web
+
+import startup
+
+# openai, pptx, docx and tiktoken are only imported by the command that needs them
+pipeline = startup.LazyModule("ai_generator.pipeline")
+templates = startup.LazyModule("ai_generator.templates")
+
+logger = logging.getLogger(__name__)
+
+ROOT = Path(__file__).resolve().parent.parent
+CONTENT_TYPES = {
+    ".pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+}
+# exceptions of process_prompt and the HTTP status they are reported with
+ERROR_STATUSES = {
+    ValueError: 400,
+    OverflowError: 503,
+    RuntimeError: 502,
+    TimeoutError: 504,
+}
+
+
+async def generate(kind, options):
+    """Runs the job described by options, the fields of the JSON request or the CLI arguments."""
+    if kind == "presentation":
+        template = options.get("template") or templates.names()[0]
+        if options.get("reply"):
+            return await pipeline.presentation_from_reply(options["reply"], template)
+        return await pipeline.generate_presentation(options["language"], options["type"], int(options["slides"]),
+                                                    options["topic"], template)
+    if options.get("reply"):
+        return await pipeline.abstract_from_reply(options["reply"])
+    return await pipeline.generate_abstract(options["language"], options["type"], options["topic"])
+
+
+def make_app(max_concurrent_jobs):
+    slots = asyncio.Semaphore(max_concurrent_jobs)
+
+    async def handle(request):
+        kind = request.match_info["kind"]
+        try:
+            options = await request.json()
+        except ValueError:
+            return web.json_response({"error": "the body must be a JSON object"}, status=400)
+        if not isinstance(options, dict):
+            return web.json_response({"error": "the body must be a JSON object"}, status=400)
+        missing = [] if options.get("reply") else [
+            field for field in ("topic", "language", "type") + (("slides",) if kind == "presentation" else ())
+            if not options.get(field)
+        ]
+        if missing:
+            return web.json_response({"error": f"missing {', '.join(missing)}, or a reply"}, status=400)
+
+        async with slots:
+            try:
+                file, title, n_used_tokens = await generate(kind, options)
+            except tuple(ERROR_STATUSES) as e:
+                status = next(status for error, status in ERROR_STATUSES.items() if isinstance(e, error))
+                return web.json_response({"error": str(e)}, status=status)
+            except IndexError:
+                return web.json_response({"error": "the reply has no slides or sections"}, status=400)
+        with file:
+            return web.Response(body=file.read(), content_type=CONTENT_TYPES[Path(title).suffix], headers={
+                "Content-Disposition": f"attachment; filename*=UTF-8''{urllib.parse.quote(title, safe='')}",
+                "X-Used-Tokens": str(n_used_tokens),
+            })
+
+    def warm_up_done(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Template warm-up failed: {future.exception()!r}")
+
+    async def warm_up(app):
+        # in the background, the API answers while the templates are slimmed
+        asyncio.get_running_loop().run_in_executor(None, templates.warm_up).add_done_callback(warm_up_done)
+
+    app = web.Application()
+    app.router.add_post("/{kind:presentation|abstract}", handle)
+    app.router.add_get("/health", lambda request: web.json_response({"ok": True}))
+    app.on_startup.append(warm_up)
+    return app
+
+
+def read_reply(path):
+    if path == "-":
+        return sys.stdin.read()
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    for kind in ("presentation", "abstract"):
+        command = commands.add_parser(kind)
+        command.add_argument("--topic")
+        command.add_argument("--reply", help="tagged reply file of the manual mode, - for stdin")
+        command.add_argument("--language", default="English")
+        command.add_argument("--type", default="Ilmiy")
+        if kind == "presentation":
+            command.add_argument("--slides", type=int, default=8)
+            command.add_argument("--template", choices=templates.names(), default=templates.names()[0])
+        command.add_argument("--output", default=".", help="directory to write the file to")
+    serve = commands.add_parser("serve")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8090)
+    serve.add_argument("--max-concurrent-jobs", type=int, default=4)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if args.command == "serve":
+        web.run_app(make_app(args.max_concurrent_jobs), host=args.host, port=args.port)
+        return
+
+    if not args.topic and not args.reply:
+        parser.error("either --topic or --reply is needed")
+    options = vars(args)
+    if args.reply:
+        options["reply"] = read_reply(args.reply)
+    try:
+        file, title, n_used_tokens = asyncio.run(generate(args.command, options))
+    except tuple(ERROR_STATUSES) as e:
+        sys.exit(f"{args.command} failed: {e}")
+    except IndexError:
+        sys.exit(f"{args.command} failed: the reply has no slides or sections")
+    path = Path(args.output) / title.replace("/", "_")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with file, open(path, "wb") as f:
+        shutil.copyfileobj(file, f)
+    print(f"{path} ({n_used_tokens} tokens)")
+
+
+if __name__ == "__main__":
+    # the template paths are relative to the repository
+    os.chdir(ROOT)
+    main()
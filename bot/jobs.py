@@ -0,0 +1,47 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class JobRegistry:
+    """Generation tasks in flight, each with the record needed to resume it.
+
+    A record is a BSON-safe dict: the kind of job, the chat and message it answers and its
+    inputs. Jobs add the results of their finished stages to it as they go (the completion,
+    the notification message), so a resumed job does not redo or pay for them again.
+    """
+
+    def __init__(self):
+        # task -> record
+        self.jobs = {}
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def spawn(self, coroutine, record):
+        task = asyncio.get_event_loop().create_task(coroutine)
+        self.jobs[task] = record
+        task.add_done_callback(lambda done: self.jobs.pop(done, None))
+        return task
+
+    async def drain(self, timeout):
+        """Waits up to timeout seconds for the jobs to finish, then cancels the rest and
+        returns their records."""
+        if not self.jobs:
+            return []
+        logger.info(f"Waiting up to {timeout}s for {len(self.jobs)} generation jobs")
+        _, pending = await asyncio.wait(list(self.jobs), timeout=timeout)
+        unfinished = [self.jobs[task] for task in pending if task in self.jobs]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        return unfinished
+
+
+async def cancel(*tasks):
+    """Cancels background loops and waits for them, so none is left pending when the event
+    loop closes."""
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
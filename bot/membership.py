@@ -0,0 +1,64 @@
+import asyncio
+import logging
+import time
+
+import telegram
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+
+class MembershipCache:
+    """Channel membership of users, cached so /menu does not wait on get_chat_member.
+
+    Members are remembered for ttl seconds. Non-members are remembered only for negative_ttl,
+    so a user who has just joined gets through on the next try. Concurrent lookups of the
+    same user and channel share one request.
+    """
+
+    def __init__(self, ttl=600, negative_ttl=15, max_entries=100000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        # (channel, user_id) -> (is_member, expires_at)
+        self.entries = {}
+        self.in_flight = {}
+
+    async def is_member(self, bot, channel, user_id):
+        key = (channel, user_id)
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            metrics.CACHE_REQUESTS.labels("membership", "hit").inc()
+            return entry[0]
+        metrics.CACHE_REQUESTS.labels("membership", "shared" if key in self.in_flight else "miss").inc()
+        if key not in self.in_flight:
+            task = asyncio.create_task(self._lookup(bot, channel, user_id))
+            task.add_done_callback(lambda done: self.in_flight.pop(key, None))
+            self.in_flight[key] = task
+        return await asyncio.shield(self.in_flight[key])
+
+    async def _lookup(self, bot, channel, user_id):
+        try:
+            chat_member = await bot.get_chat_member(chat_id=channel, user_id=user_id)
+            logger.debug(f"Chat member status of {user_id} in {channel}: {chat_member.status}")
+            is_member = chat_member.status in MEMBER_STATUSES
+        except telegram.error.BadRequest as e:
+            # Handle the case where the user is not found in the channel
+            logger.warning(f"User {user_id} not found in channel {channel}: {e}")
+            is_member = False
+        self._store((channel, user_id), is_member)
+        return is_member
+
+    def _store(self, key, is_member):
+        now = time.monotonic()
+        if len(self.entries) >= self.max_entries:
+            self.entries = {key: entry for key, entry in self.entries.items() if entry[1] > now}
+        self.entries[key] = (is_member, now + (self.ttl if is_member else self.negative_ttl))
+
+    async def check(self, bot, channels, user_id):
+        """True when the user is a member of all channels, which are looked up concurrently."""
+        results = await asyncio.gather(*(self.is_member(bot, channel, user_id) for channel in channels))
+        return all(results)
@@ -0,0 +1,34 @@
+import resource
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180)
+MEMORY_BUCKETS = (0, 2 ** 20, 4 * 2 ** 20, 16 * 2 ** 20, 64 * 2 ** 20, 256 * 2 ** 20)
+
+# stage: llm, image_download, render, save, upload
+STAGE_SECONDS = Histogram("presento_stage_seconds", "Latency of the generation pipeline stages",
+                          ["stage"], buckets=STAGE_BUCKETS)
+# cache: image, speculation, package_part, membership, image_library; result: hit, shared, partial, miss
+CACHE_REQUESTS = Counter("presento_cache_requests_total", "Cache lookups by result", ["cache", "result"])
+RETRIES = Counter("presento_retries_total", "Retried or hedged operations", ["operation"])
+# outcome: ok, error, invalid, skipped (blocked domain or failing host)
+IMAGE_LINKS = Counter("presento_image_links_total", "Image result links by what came of them", ["outcome"])
+FAILURES = Counter("presento_failures_total", "Failed pipeline stages", ["stage"])
+JOBS_IN_FLIGHT = Gauge("presento_jobs_in_flight", "Generation jobs being processed", ["kind"])
+QUEUE_DEPTH = Gauge("presento_queue_depth", "Work waiting to be started", ["queue"])
+STARTUP_SECONDS = Gauge("presento_startup_seconds", "Duration of the startup phases and when they were reached",
+                        ["phase"])
+SESSIONS = Gauge("presento_sessions", "Conversation sessions kept in memory or spilled to Mongo", ["state"])
+JOB_PEAK_RSS_GROWTH = Histogram("presento_job_peak_rss_growth_bytes",
+                                "How much a generation job raised the peak RSS of the process",
+                                ["kind"], buckets=MEMORY_BUCKETS)
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def start_server(port, address="127.0.0.1"):
+    if port:
+        start_http_server(port, addr=address)
@@ -0,0 +1,167 @@
+"""CPU and memory profiles of the running bot, taken on demand with the admin /profile command.
+
+Nothing is hooked while profiling is off: cProfile and the sampler only run for the window
+they were asked for, and tracemalloc traces allocations between start_tracing and
+stop_tracing. Every report is returned as (filename, bytes) pairs to send as documents.
+"""
+import asyncio
+import collections
+import cProfile
+import io
+import marshal
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+MAX_SECONDS = 120
+SAMPLE_INTERVAL = 0.005
+REPORT_LINES = 60
+# frames kept per allocation by tracemalloc, more show who called but cost memory
+TRACE_FRAMES = 10
+
+# one CPU profile at a time, both profilers would mostly measure each other
+cpu_lock = asyncio.Lock()
+# last tracemalloc snapshot, the next one is compared to it
+last_snapshot = None
+
+
+def _check_seconds(seconds):
+    if not 0 < seconds <= MAX_SECONDS:
+        raise ValueError(f"the window must be 1 to {MAX_SECONDS} seconds")
+
+
+async def cprofile(seconds):
+    """Profiles the event loop thread for seconds with cProfile. Work handed to threads
+    (rendering, Mongo) shows up only as the await, see sample() for those."""
+    _check_seconds(seconds)
+    if cpu_lock.locked():
+        raise RuntimeError("a CPU profile is already running")
+    async with cpu_lock:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+
+    report = io.StringIO()
+    stats = pstats.Stats(profile, stream=report)
+    stats.strip_dirs()
+    for order in ("cumulative", "tottime"):
+        report.write(f"==== sorted by {order} ====\n")
+        stats.sort_stats(order).print_stats(REPORT_LINES)
+    # the raw stats load with pstats.Stats(path) or snakeviz
+    raw = marshal.dumps(pstats.Stats(profile).stats)
+    return [("cprofile.txt", report.getvalue().encode()), ("cprofile.pstats", raw)]
+
+
+async def sample(seconds):
+    """Samples the stacks of all threads every SAMPLE_INTERVAL for seconds. Coarser than
+    cProfile but it sees the worker threads too and barely slows the bot down."""
+    _check_seconds(seconds)
+    if cpu_lock.locked():
+        raise RuntimeError("a CPU profile is already running")
+    async with cpu_lock:
+        stacks, n_samples = await asyncio.to_thread(_sample_stacks, seconds)
+
+    own = collections.Counter()
+    cumulative = collections.Counter()
+    for stack, count in stacks.items():
+        own[stack[-1]] += count
+        for function in set(stack):
+            cumulative[function] += count
+
+    report = io.StringIO()
+    report.write(f"{n_samples} samples of all threads, {SAMPLE_INTERVAL * 1000:.0f} ms apart\n"
+                 "idle threads are sampled too: time in select, wait and sleep is waiting\n")
+    for title, counter in (("cumulative", cumulative), ("own", own)):
+        report.write(f"\n==== sorted by {title} samples ====\n")
+        for function, count in counter.most_common(REPORT_LINES):
+            report.write(f"{count:>8} {100 * count / n_samples:>6.1f}%  {function}\n")
+    # one "outer;...;inner count" line per stack, the input of flamegraph.pl and speedscope
+    collapsed = "".join(f"{';'.join(stack)} {count}\n" for stack, count in stacks.most_common())
+    return [("sample.txt", report.getvalue().encode()), ("sample.collapsed", collapsed.encode())]
+
+
+def _sample_stacks(seconds):
+    own_thread = threading.get_ident()
+    stacks = collections.Counter()
+    n_samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            stacks[tuple(reversed(stack))] += 1
+        n_samples += 1
+        time.sleep(SAMPLE_INTERVAL)
+    return stacks, n_samples
+
+
+def start_tracing():
+    global last_snapshot
+    if tracemalloc.is_tracing():
+        raise RuntimeError("tracemalloc is already tracing")
+    last_snapshot = None
+    tracemalloc.start(TRACE_FRAMES)
+
+
+def stop_tracing():
+    global last_snapshot
+    if not tracemalloc.is_tracing():
+        raise RuntimeError("tracemalloc is not tracing")
+    tracemalloc.stop()
+    last_snapshot = None
+
+
+async def snapshot():
+    """Takes a tracemalloc snapshot and reports the top allocation sites, and what grew
+    since the previous snapshot."""
+    global last_snapshot
+    if not tracemalloc.is_tracing():
+        raise RuntimeError("tracemalloc is not tracing, start it first")
+    current, previous = await asyncio.to_thread(_take_snapshot), last_snapshot
+    last_snapshot = current
+    return await asyncio.to_thread(_snapshot_report, current, previous)
+
+
+def _take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ))
+
+
+def _snapshot_report(current, previous):
+    traced, peak = tracemalloc.get_traced_memory()
+    report = io.StringIO()
+    report.write(f"traced {traced / 2 ** 20:.1f} MiB, peak {peak / 2 ** 20:.1f} MiB, "
+                 f"tracemalloc itself {tracemalloc.get_tracemalloc_memory() / 2 ** 20:.1f} MiB\n")
+    report.write("\n==== top allocation sites ====\n")
+    for stat in current.statistics("lineno")[:REPORT_LINES]:
+        report.write(f"{stat}\n")
+    files = [("tracemalloc.txt", report.getvalue().encode())]
+    if previous is None:
+        return files
+
+    diff = io.StringIO()
+    diff.write("==== growth by allocation site since the previous snapshot ====\n")
+    for stat in current.compare_to(previous, "lineno")[:REPORT_LINES]:
+        diff.write(f"{stat}\n")
+    diff.write("\n==== largest growth by traceback ====\n")
+    for stat in current.compare_to(previous, "traceback")[:10]:
+        diff.write(f"\n{stat}\n")
+        for line in stat.traceback.format():
+            diff.write(f"{line}\n")
+    files.append(("tracemalloc_diff.txt", diff.getvalue().encode()))
+    return files
@@ -0,0 +1,154 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# priority classes, lower is sent first
+INTERACTIVE = 0
+DOCUMENT = 1
+REPORT = 2
+
+DOCUMENT_ENDPOINTS = {"sendDocument", "sendMediaGroup", "sendPhoto"}
+# buckets of chats that have been idle this long are full again and can be forgotten
+CHAT_IDLE_SECONDS = 300
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """Takes a token, possibly in advance, and returns how long to wait until it is due."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """Spreads outgoing Bot API requests under Telegram's limits instead of running into them.
+
+    Every request first waits for its chat's bucket (about one message per second in private
+    chats, 20 per minute in groups), then queues for the global bucket, which is granted in
+    priority order: interactive replies, then documents, then reports. A RetryAfter pauses all
+    requests for the time Telegram asks and the request is queued again, so nothing is dropped.
+
+    The priority is taken from rate_limit_args when a call passes one, e.g.
+    send_message(..., rate_limit_args=rate_limiter.REPORT), otherwise from the endpoint and
+    whether the chat is one of report_chat_ids.
+    """
+
+    def __init__(self, per_second=30, chat_per_second=1.0, chat_burst=3, group_per_minute=20,
+                 report_chat_ids=()):
+        self.per_second = per_second
+        self.chat_per_second = chat_per_second
+        self.chat_burst = chat_burst
+        self.group_per_minute = group_per_minute
+        self.report_chat_ids = set(report_chat_ids)
+        self.global_bucket = TokenBucket(per_second, per_second)
+        self.chat_buckets = {}
+        self.waiting = []
+        self.counter = itertools.count()
+        self.has_waiting = asyncio.Event()
+        # monotonic time until which Telegram asked to stop sending
+        self.paused_until = 0
+        self.dispatcher = None
+
+    async def initialize(self):
+        # called by both the application and the updater when they initialize the bot
+        if self.dispatcher is None:
+            self.dispatcher = asyncio.create_task(self.dispatch())
+
+    async def shutdown(self):
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.dispatcher
+            self.dispatcher = None
+
+    def priority(self, endpoint, chat_id, rate_limit_args):
+        if rate_limit_args is not None:
+            return rate_limit_args
+        if chat_id in self.report_chat_ids:
+            return REPORT
+        if endpoint in DOCUMENT_ENDPOINTS:
+            return DOCUMENT
+        return INTERACTIVE
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                idle_since = time.monotonic() - CHAT_IDLE_SECONDS
+                self.chat_buckets = {chat: bucket for chat, bucket in self.chat_buckets.items()
+                                     if bucket.updated > idle_since}
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_per_minute / 60, self.group_per_minute)
+            else:
+                bucket = TokenBucket(self.chat_per_second, self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def dispatch(self):
+        """Grants the global bucket's tokens to the waiting requests, highest priority first."""
+        while True:
+            await self.has_waiting.wait()
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            delay = self.global_bucket.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+            while self.waiting:
+                _, _, future = heapq.heappop(self.waiting)
+                if not future.done():
+                    future.set_result(None)
+                    break
+            metrics.QUEUE_DEPTH.labels("telegram").set(len(self.waiting))
+            if not self.waiting:
+                self.has_waiting.clear()
+
+    async def turn(self, priority, order):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, order, future))
+        metrics.QUEUE_DEPTH.labels("telegram").set(len(self.waiting))
+        self.has_waiting.set()
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            # no chat (answerCallbackQuery, getMe, ...) or a channel username
+            chat_id = None
+        priority = self.priority(endpoint, chat_id, rate_limit_args)
+
+        if chat_id is not None:
+            delay = self.chat_bucket(chat_id).reserve()
+            if delay:
+                await asyncio.sleep(delay)
+        # a request retried after RetryAfter keeps its place in line
+        order = next(self.counter)
+        while True:
+            await self.turn(priority, order)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                metrics.RETRIES.labels("telegram_flood").inc()
+                logger.warning(f"Flood limit hit on {endpoint}, pausing requests for {e.retry_after}s")
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import telegram
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+BSON_TYPES = (str, int, float, bool, type(None))
+# the store reaches into these PTB internals, checked against the version requirements.txt pins
+PTB_VERSION = "20.2"
+CONVERSATION_INTERNALS = ("_child_conversations", "_conversations")
+APPLICATION_INTERNALS = ("_user_ids_to_be_deleted_in_persistence", "_chat_ids_to_be_deleted_in_persistence")
+
+
+def check_ptb_internals(application, conversation):
+    """Raises RuntimeError at startup when this PTB lacks an attribute the store uses."""
+    if telegram.__version__ != PTB_VERSION:
+        logger.warning(f"python-telegram-bot {telegram.__version__} is not {PTB_VERSION}, "
+                       "which the session store was checked against")
+    missing = [f"ConversationHandler.{attr}" for attr in CONVERSATION_INTERNALS if not hasattr(conversation, attr)]
+    missing += [f"Application.{attr}" for attr in APPLICATION_INTERNALS if not hasattr(application, attr)]
+    if missing:
+        raise RuntimeError(f"python-telegram-bot {telegram.__version__} has no {', '.join(missing)}, "
+                           "the session store cannot bound the conversations")
+
+
+def conversation_handlers(handler):
+    """handler and all the conversations nested in it."""
+    yield handler
+    for child in handler._child_conversations:
+        yield from conversation_handlers(child)
+
+
+def storable(data):
+    """The entries of a user_data/chat_data dict that can be written to Mongo. The rest, like
+    the Message of the last menu, only matters while the session is in memory."""
+    return [[key, value] for key, value in data.items()
+            if isinstance(key, str) and isinstance(value, BSON_TYPES)]
+
+
+class SessionStore:
+    """Bounds what the bot keeps per conversation: user_data, chat_data and the states of the
+    ConversationHandlers, keyed like the conversations by (chat_id, user_id).
+
+    A session idle for idle_ttl seconds is abandoned: its conversations end and its data is
+    dropped. Beyond max_sessions the least recently active sessions are evicted early, and
+    with spill enabled they are written to Mongo and restored on the user's next update, so
+    the conversation continues where it stopped, also after a restart or on another replica.
+    The bot is used in private chats, where the chat and the user are the same, so a session
+    owns its chat_data.
+    """
+
+    def __init__(self, application, conversation, db, idle_ttl=1800, max_sessions=10000, spill=True):
+        check_ptb_internals(application, conversation)
+        self.application = application
+        self.handlers = list(conversation_handlers(conversation))
+        self.db = db
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.spill = spill
+        # (chat_id, user_id) -> last activity, least recent first
+        self.sessions = OrderedDict()
+        # spilled sessions in Mongo at the last sweep, None before the first; while there are
+        # none, a key that is not in memory is not looked up
+        self.n_spilled = None
+
+    def handler(self):
+        """Runs before every other handler, group -1, to keep the activity and restore spills."""
+        return TypeHandler(Update, self.touch)
+
+    async def touch(self, update, context):
+        if update.effective_chat is None or update.effective_user is None:
+            return
+        key = (update.effective_chat.id, update.effective_user.id)
+        # not in memory here, so it may have been spilled by this or any other process
+        if key not in self.sessions and self.spill and self.n_spilled != 0:
+            document = await asyncio.to_thread(self.db.restore_session, key)
+            if document is not None:
+                self.restore(key, document, context)
+        self.sessions[key] = time.monotonic()
+        self.sessions.move_to_end(key)
+
+    def restore(self, key, document, context):
+        context.user_data.update(dict(document["user_data"]))
+        context.chat_data.update(dict(document["chat_data"]))
+        for handler, state in zip(self.handlers, document["states"]):
+            if state is not None:
+                handler._conversations[key] = state
+
+    def drop(self, key):
+        chat_id, user_id = key
+        states = [handler._conversations.pop(key, None) for handler in self.handlers]
+        user_data = self.application.user_data.get(user_id, {})
+        chat_data = self.application.chat_data.get(chat_id, {})
+        self.application.drop_user_data(user_id)
+        self.application.drop_chat_data(chat_id)
+        if self.application.persistence is None:
+            # only kept for the persistence, without one they would pile up
+            self.application._user_ids_to_be_deleted_in_persistence.discard(user_id)
+            self.application._chat_ids_to_be_deleted_in_persistence.discard(chat_id)
+        return {"states": states, "user_data": storable(user_data), "chat_data": storable(chat_data)}
+
+    async def sweep(self):
+        now = time.monotonic()
+        abandoned, evicted = [], []
+        for key, last_seen in self.sessions.items():
+            if now - last_seen > self.idle_ttl:
+                abandoned.append(key)
+            elif len(self.sessions) - len(abandoned) - len(evicted) > self.max_sessions:
+                evicted.append(key)
+            else:
+                break
+        for key in abandoned:
+            del self.sessions[key]
+            self.drop(key)
+
+        spills = []
+        for key in evicted:
+            del self.sessions[key]
+            session = self.drop(key)
+            # a state still waiting on a non-blocking callback cannot be written down
+            if self.spill and any(session["states"]) and all(
+                    isinstance(state, BSON_TYPES) for state in session["states"]):
+                spills.append((key, session))
+        if spills:
+            await asyncio.to_thread(self.db.spill_sessions, spills)
+
+        metrics.SESSIONS.labels("memory").set(len(self.sessions))
+        if self.spill:
+            # spills of sessions that were never resumed expire in Mongo by themselves
+            self.n_spilled = await asyncio.to_thread(self.db.count_spilled_sessions)
+            metrics.SESSIONS.labels("spilled").set(self.n_spilled)
+        if abandoned or evicted:
+            logger.info(f"Sessions: {len(abandoned)} abandoned, {len(evicted)} evicted ({len(spills)} spilled), "
+                        f"{len(self.sessions)} in memory")
+
+    async def sweep_periodically(self, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Session sweep failed: {e}")
@@ -0,0 +1,61 @@
+"""Startup phases of the bot and the modules it loads after it starts polling."""
+import time
+
+STARTED = time.perf_counter()
+
+import contextlib
+import importlib
+import logging
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# phase -> seconds
+phases = {}
+last_mark = STARTED
+
+
+class LazyModule:
+    """Stands in for a module until one of its attributes is used, then imports it. The
+    import lock makes a first use racing load() wait for the same import."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+
+@contextlib.contextmanager
+def phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = time.perf_counter() - started
+
+
+def mark(name):
+    """Ends a phase of the sequential startup, which began at the previous mark."""
+    global last_mark
+    now = time.perf_counter()
+    phases[name] = now - last_mark
+    last_mark = now
+
+
+def report(milestone, names):
+    """Logs and exports how long the named phases took, and when milestone was reached."""
+    elapsed = time.perf_counter() - STARTED
+    metrics.STARTUP_SECONDS.labels(milestone).set(elapsed)
+    for name in names:
+        if name in phases:
+            metrics.STARTUP_SECONDS.labels(name).set(phases[name])
+    breakdown = ", ".join(f"{name} {phases[name]:.2f}s" for name in names if name in phases)
+    logger.info(f"{milestone} {elapsed:.2f}s after start ({breakdown})")
@@ -0,0 +1,91 @@
+import asyncio
+import contextlib
+import contextvars
+import logging
+import time
+import uuid
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+current_span = contextvars.ContextVar("current_span", default=None)
+
+# finished traces waiting to be written to Mongo
+pending = []
+
+
+class Trace:
+    """Span tree of one generation job. Spans are kept flat, each pointing to its parent."""
+
+    def __init__(self, kind, user_id):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.user_id = user_id
+        self.started_at = datetime.utcnow()
+        self.start = time.monotonic()
+        self.spans = []
+
+    @contextlib.contextmanager
+    def activate(self):
+        token = current_trace.set(self)
+        try:
+            yield self
+        finally:
+            current_trace.reset(token)
+
+    def finish(self):
+        pending.append({
+            "_id": self.id,
+            "kind": self.kind,
+            "user_id": self.user_id,
+            "started_at": self.started_at,
+            "duration": time.monotonic() - self.start,
+            "spans": self.spans,
+        })
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Records a span in the active trace, a no-op outside of one. Yields the attributes
+    dict so that values known only at the end (chosen URL, size) can be added."""
+    trace = current_trace.get()
+    if trace is None:
+        yield attributes
+        return
+
+    parent = current_span.get()
+    record = {
+        "id": len(trace.spans),
+        "parent": parent["id"] if parent else None,
+        "name": name,
+        "start": time.monotonic() - trace.start,
+        "attributes": attributes,
+    }
+    trace.spans.append(record)
+    token = current_span.set(record)
+    try:
+        yield attributes
+    except BaseException as e:
+        record["error"] = repr(e)
+        raise
+    finally:
+        record["duration"] = time.monotonic() - trace.start - record["start"]
+        current_span.reset(token)
+
+
+async def flush(write):
+    if not pending:
+        return
+    traces = pending[:]
+    del pending[:]
+    try:
+        await asyncio.to_thread(write, traces)
+    except Exception as e:
+        logger.error(f"Could not persist {len(traces)} traces: {e}")
+
+
+async def flush_periodically(write, interval=10):
+    while True:
+        await asyncio.sleep(interval)
+        await flush(write)
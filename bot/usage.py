@@ -0,0 +1,51 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# events flushed this much after they happened are still counted in their hour
+LATE_EVENTS = timedelta(minutes=10)
+
+# usage events waiting to be written to Mongo
+pending = []
+
+
+def record(kind, user_id, tokens=0, documents=1):
+    """Appends a usage event, e.g. a generation and the tokens it was charged. The events are
+    written in batches by flush_periodically, never on the way of the reply."""
+    pending.append({
+        "at": datetime.utcnow(),
+        "user_id": user_id,
+        "kind": kind,
+        "tokens": tokens,
+        "documents": documents,
+    })
+
+
+async def flush(write):
+    if not pending:
+        return
+    events = pending[:]
+    del pending[:]
+    try:
+        await asyncio.to_thread(write, events)
+    except Exception as e:
+        logger.error(f"Could not persist {len(events)} usage events: {e}")
+
+
+async def flush_periodically(write, interval=10):
+    while True:
+        await asyncio.sleep(interval)
+        await flush(write)
+
+
+async def roll_up_periodically(roll_up, interval):
+    """Recomputes the rollups of the hours and days that can still get events. Every replica
+    does it, the rollups are replaced with the same result."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(roll_up, datetime.utcnow() - LATE_EVENTS)
+        except Exception as e:
+            logger.error(f"Could not roll up usage: {e}")
@@ -0,0 +1,215 @@
+"""End-to-end load test of the bot against local stand-ins for Telegram, OpenAI and Bing.
+
+The real bot runs as a subprocess with a generated config pointing all its external
+services at aiohttp servers in this process. Virtual users click through the /menu
+presentation flow, and at the end the throughput, end-to-end and per-stage latency
+(scraped from the bot's metrics endpoint) and the bot's memory are reported.
+
+A MongoDB is still needed, the data goes to a separate database:
+
+    python -m loadtest --users 20 --duration 120 --mongodb-uri mongodb://localhost:27017
+    python -m loadtest --openai-latency 4,0.6,0.02 --bing-latency 0.5,0.8,0.1
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import Counter
+from pathlib import Path
+
+import yaml
+from prometheus_client.parser import text_string_to_metric_families
+
+from loadtest.fake_servers import FakeBing, FakeOpenAI, FakeTelegram, Latency, start_site
+from loadtest.virtual_users import VirtualUser
+
+ROOT = Path(__file__).resolve().parent.parent
+HOST = "127.0.0.1"
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.failures = Counter()
+
+    def completed(self, latency):
+        self.latencies.append(latency)
+
+    def failed(self, reason):
+        self.failures[reason] += 1
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, quantile):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+
+def histogram_quantile(buckets, quantile):
+    """Linear interpolation inside cumulative (upper bound, count) buckets, like PromQL."""
+    total = buckets[-1][1]
+    if not total:
+        return float("nan")
+    rank = quantile * total
+    lower, below = 0.0, 0.0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float("inf"):
+                return lower
+            return lower + (bound - lower) * (rank - below) / max(count - below, 1e-9)
+        lower, below = bound, count
+    return lower
+
+
+def stage_latencies(metrics_text):
+    stages = {}
+    for family in text_string_to_metric_families(metrics_text):
+        if family.name != "presento_stage_seconds":
+            continue
+        for sample in family.samples:
+            stage = stages.setdefault(sample.labels["stage"], {"buckets": []})
+            if sample.name.endswith("_bucket"):
+                stage["buckets"].append((float(sample.labels["le"]), sample.value))
+            elif sample.name.endswith("_sum"):
+                stage["sum"] = sample.value
+            elif sample.name.endswith("_count"):
+                stage["count"] = sample.value
+    return stages
+
+
+def rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+def write_config(directory, args, ports):
+    config = {
+        "telegram_token": "123456:LOADTEST",
+        "openai_api_key": "sk-loadtest",
+        "provider_token": "",
+        "admin_chat_id": 0,
+        "allowed_telegram_usernames": [],
+        "telegram_base_url": f"http://{HOST}:{ports['telegram']}/bot",
+        "bing_base_url": f"http://{HOST}:{ports['bing']}",
+        "llm_backends": [{"name": "fake", "api_base": f"http://{HOST}:{ports['openai']}/v1",
+                          "model": "gpt-3.5-turbo"}],
+        "metrics_port": ports["metrics"],
+        "metrics_address": HOST,
+        # bot.wait() below gives the bot 30s to drain its jobs and exit
+        "shutdown_drain_seconds": 20,
+    }
+    with open(directory / "config.yml", "w") as f:
+        yaml.safe_dump(config, f)
+    with open(directory / "config.env", "w") as f:
+        f.write(f"MONGODB_PORT=27017\nMONGODB_URI={args.mongodb_uri}\nMONGODB_DATABASE={args.mongodb_database}\n")
+    shutil.copy(ROOT / "config" / "chat_modes.yml", directory / "chat_modes.yml")
+
+
+async def sample_memory(pid, samples, stop):
+    while not stop.is_set():
+        rss = rss_bytes(pid)
+        if rss is not None:
+            samples.append(rss)
+        await asyncio.sleep(1)
+
+
+async def main(args):
+    ports = {name: free_port() for name in ("telegram", "openai", "bing", "metrics")}
+    telegram = FakeTelegram(Latency.parse(args.telegram_latency))
+    openai = FakeOpenAI(Latency.parse(args.openai_latency))
+    bing = FakeBing(f"http://{HOST}:{ports['bing']}", Latency.parse(args.bing_latency),
+                    Latency.parse(args.image_latency))
+    runners = [await start_site(telegram.app(), HOST, ports["telegram"]),
+               await start_site(openai.app(), HOST, ports["openai"]),
+               await start_site(bing.app(), HOST, ports["bing"])]
+
+    config_dir = Path(tempfile.mkdtemp(prefix="presento-loadtest-"))
+    write_config(config_dir, args, ports)
+    bot = subprocess.Popen([sys.executable, "bot/bot.py"], cwd=ROOT,
+                           env={**os.environ, "PRESENTO_CONFIG_DIR": str(config_dir)})
+    memory, stop = [], asyncio.Event()
+    try:
+        started = time.monotonic()
+        while not telegram.calls["getUpdates"]:
+            if bot.poll() is not None or time.monotonic() - started > args.startup_timeout:
+                raise SystemExit("The bot did not start polling")
+            await asyncio.sleep(0.1)
+        print(f"Bot polling after {time.monotonic() - started:.2f}s, running {args.users} users "
+              f"for {args.duration}s")
+
+        memory_task = asyncio.create_task(sample_memory(bot.pid, memory, stop))
+        stats = Stats()
+        run_started = time.monotonic()
+        stop_at = run_started + args.duration
+        users = [VirtualUser(telegram, think_time=args.think_time) for _ in range(args.users)]
+        await asyncio.gather(*(user.run(stats, stop_at) for user in users))
+        elapsed = time.monotonic() - run_started
+        stop.set()
+        await memory_task
+
+        metrics_url = f"http://{HOST}:{ports['metrics']}/metrics"
+        metrics_text = await asyncio.to_thread(lambda: urllib.request.urlopen(metrics_url).read().decode())
+    finally:
+        bot.terminate()
+        bot.wait(timeout=30)
+        for runner in runners:
+            await runner.cleanup()
+        shutil.rmtree(config_dir, ignore_errors=True)
+
+    report(stats, elapsed, stage_latencies(metrics_text), memory, telegram, openai)
+
+
+def report(stats, elapsed, stages, memory, telegram, openai):
+    print(f"\nJobs completed: {len(stats.latencies)}, failed: {sum(stats.failures.values())}, "
+          f"{len(stats.latencies) / elapsed * 60:.1f} jobs/minute")
+    for reason, count in stats.failures.most_common(5):
+        print(f"  {count:>5} x {reason}")
+    print(f"End-to-end (topic sent -> document received): p50 {percentile(stats.latencies, 0.5):.2f}s  "
+          f"p95 {percentile(stats.latencies, 0.95):.2f}s  p99 {percentile(stats.latencies, 0.99):.2f}s")
+
+    print(f"\n{'stage':<16}{'count':>8}{'mean':>9}{'p50':>9}{'p95':>9}")
+    for name, stage in sorted(stages.items()):
+        count = stage.get("count", 0)
+        mean = stage.get("sum", 0) / count if count else float("nan")
+        print(f"{name:<16}{count:>8.0f}{mean:>9.3f}{histogram_quantile(stage['buckets'], 0.5):>9.3f}"
+              f"{histogram_quantile(stage['buckets'], 0.95):>9.3f}")
+
+    if memory:
+        print(f"\nBot RSS: start {memory[0] / 2 ** 20:.0f} MiB, peak {max(memory) / 2 ** 20:.0f} MiB, "
+              f"end {memory[-1] / 2 ** 20:.0f} MiB")
+    print(f"OpenAI requests: {openai.requests}, Telegram calls: {sum(telegram.calls.values())} "
+          f"({telegram.flood_errors} rejected with 429)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m loadtest", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=60, help="seconds")
+    parser.add_argument("--think-time", type=float, default=0.5, help="mean seconds between clicks")
+    parser.add_argument("--mongodb-uri", default="mongodb://localhost:27017")
+    parser.add_argument("--mongodb-database", default="presento_loadtest")
+    parser.add_argument("--telegram-latency", default="0.02,0.3,0", help="median,sigma,failure_rate")
+    parser.add_argument("--openai-latency", default="2.0,0.5,0")
+    parser.add_argument("--bing-latency", default="0.3,0.5,0")
+    parser.add_argument("--image-latency", default="0.2,0.7,0.05")
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,218 @@
+import asyncio
+import itertools
+import json
+import math
+import random
+import struct
+import time
+import zlib
+from collections import defaultdict
+
+from aiohttp import web
+
+
+class Latency:
+    """Log-normal latency around a median, with a probability of failing the request."""
+
+    def __init__(self, median=0.05, sigma=0.5, failure_rate=0.0):
+        self.median = median
+        self.sigma = sigma
+        self.failure_rate = failure_rate
+
+    @classmethod
+    def parse(cls, spec):
+        """Parses 'median[,sigma[,failure_rate]]', e.g. '2.5,0.6,0.02'."""
+        return cls(*(float(value) for value in spec.split(",")))
+
+    async def wait(self):
+        if self.median > 0:
+            await asyncio.sleep(random.lognormvariate(math.log(self.median), self.sigma))
+        return random.random() < self.failure_rate
+
+
+async def start_site(app, host, port):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner
+
+
+def make_png(width=64, height=36):
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    color = bytes(random.randrange(256) for _ in range(3))
+    raw = b"".join(b"\x00" + color * width for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw))
+            + chunk(b"IEND", b""))
+
+
+class FakeTelegram:
+    """Minimal Bot API: long polling getUpdates, the send/edit methods the bot uses, and a
+    per-chat inbox of everything the bot sent so that virtual users can react to it."""
+
+    def __init__(self, latency=None):
+        self.latency = latency or Latency(0.02, 0.3)
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.new_update = asyncio.Event()
+        self.inboxes = defaultdict(asyncio.Queue)
+        self.calls = defaultdict(int)
+        self.flood_errors = 0
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    def push_update(self, update):
+        update["update_id"] = next(self.update_ids)
+        self.updates.append(update)
+        self.new_update.set()
+
+    def message(self, chat_id, text, **extra):
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Presento"},
+            "text": text,
+            **extra,
+        }
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return await self.get_updates(params)
+
+        if await self.latency.wait():
+            self.flood_errors += 1
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                      "parameters": {"retry_after": 1}}, status=429)
+        return web.json_response({"ok": True, "result": await self.dispatch(method, params)})
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset", 0) or 0)
+        deadline = time.monotonic() + float(params.get("timeout", 0) or 0)
+        while True:
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            if self.updates or time.monotonic() >= deadline:
+                return web.json_response({"ok": True, "result": self.updates[:100]})
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                pass
+
+    async def dispatch(self, method, params):
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+        reply_markup = json.loads(params["reply_markup"]) if params.get("reply_markup") else None
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Presento", "username": "presento_load_bot"}
+        if method == "getChatMember":
+            return {"status": "member", "user": {"id": int(params["user_id"]), "is_bot": False, "first_name": "vu"}}
+        if method in ("sendMessage", "editMessageText"):
+            extra = {"reply_markup": reply_markup} if reply_markup else {}
+            if method == "editMessageText":
+                extra["message_id"] = int(params["message_id"])
+            message = self.message(chat_id, params.get("text", ""), **extra)
+            await self.inboxes[chat_id].put((method, message))
+            return message
+        if method == "sendDocument":
+            document = params["document"]
+            message = self.message(chat_id, "", document={
+                "file_id": f"file{next(self.message_ids)}",
+                "file_unique_id": "u",
+                "file_name": getattr(document, "filename", "document"),
+                "file_size": len(document.file.read()) if hasattr(document, "file") else 0,
+            })
+            await self.inboxes[chat_id].put((method, message))
+            return message
+        if method == "sendMediaGroup":
+            messages = [self.message(chat_id, "", document={"file_id": f"file{next(self.message_ids)}",
+                                                            "file_unique_id": "u"})
+                        for _ in json.loads(params["media"])]
+            for message in messages:
+                await self.inboxes[chat_id].put(("sendDocument", message))
+            return messages
+        # setMyCommands, deleteWebhook, answerCallbackQuery, deleteMessage, ...
+        return True
+
+
+class FakeOpenAI:
+    """Chat completions endpoint answering with a tagged deck of the requested length."""
+
+    def __init__(self, latency=None):
+        self.latency = latency or Latency(2.0, 0.5)
+        self.requests = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        return app
+
+    async def handle(self, request):
+        body = await request.json()
+        self.requests += 1
+        if await self.latency.wait():
+            return web.json_response({"error": {"message": "overloaded", "type": "server_error"}}, status=503)
+        prompt = body["messages"][-1]["content"]
+        slides = next((int(word) for word in prompt.split() if word.isdigit()), 6)
+        content = self.presentation(min(slides, 15))
+        return web.json_response({
+            "id": f"chatcmpl-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-3.5-turbo"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4,
+                      "total_tokens": (len(prompt) + len(content)) // 4},
+        })
+
+    @staticmethod
+    def presentation(slides):
+        parts = ["[L_TS]\n[TITLE]Load Test Deck[/TITLE]\n[SUBTITLE]Generated by the fake backend[/SUBTITLE]"]
+        for i in range(1, slides - 1):
+            if i % 2:
+                parts.append(f"[L_IS]\n[TITLE]Image slide {i}[/TITLE]\n[CONTENT]• point one\n• point two[/CONTENT]\n"
+                             f"[IMAGE]Mountain View {i}[/IMAGE]")
+            else:
+                parts.append(f"[L_CS]\n[TITLE]Content slide {i}[/TITLE]\n[CONTENT]• point one\n• point two[/CONTENT]")
+        parts.append("[L_THS]\n[TITLE]Thank you[/TITLE]")
+        return "\n\n[SLIDEBREAK]\n\n".join(parts)
+
+
+class FakeBing:
+    """Bing images/async results pages whose murl links point at images served by this app."""
+
+    def __init__(self, base_url, latency=None, image_latency=None, links_per_page=5):
+        self.base_url = base_url
+        self.latency = latency or Latency(0.3, 0.5)
+        self.image_latency = image_latency or Latency(0.2, 0.7)
+        self.links_per_page = links_per_page
+        self.images = [make_png() for _ in range(8)]
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/images/async", self.results)
+        app.router.add_get("/img/{n}", self.image)
+        return app
+
+    async def results(self, request):
+        if await self.latency.wait():
+            return web.Response(status=503)
+        links = "".join(f"murl&quot;:&quot;{self.base_url}/img/{random.randrange(10 ** 6)}&quot;"
+                        for _ in range(self.links_per_page))
+        return web.Response(text=f"<div>{links}</div>", content_type="text/html")
+
+    async def image(self, request):
+        if await self.image_latency.wait():
+            return web.Response(text="<html>hotlinking is not allowed</html>", content_type="text/html")
+        image = self.images[int(request.match_info["n"]) % len(self.images)]
+        return web.Response(body=image, content_type="image/png")
@@ -0,0 +1,86 @@
+import asyncio
+import itertools
+import random
+import time
+
+TEMPLATES = ["Mountains", "Organic", "East Asia", "Explore", "3D Float", "Luminous", "Academic", "Snowflake", "Floral",
+             "Minimal"]
+COUNTS = ["4", "8", "15"]
+TOPICS = ["Mount Everest", "Photosynthesis", "The Silk Road", "Renewable energy", "Amir Temur", "Machine learning"]
+
+user_ids = itertools.count(10 ** 9)
+
+
+class FlowError(Exception):
+    pass
+
+
+class VirtualUser:
+    """Drives /menu -> Taqdimot -> language -> template -> type -> count -> topic like a person would,
+    clicking the buttons of the keyboards the bot actually sent."""
+
+    def __init__(self, telegram, think_time=0.5, reply_timeout=30.0, job_timeout=300.0):
+        self.telegram = telegram
+        self.think_time = think_time
+        self.reply_timeout = reply_timeout
+        self.job_timeout = job_timeout
+
+    async def run(self, stats, stop_at):
+        while time.monotonic() < stop_at:
+            # a fresh user per job, so that every job starts with the default token balance
+            user_id = next(user_ids)
+            try:
+                latency = await self.generate(user_id)
+            except (FlowError, asyncio.TimeoutError) as e:
+                stats.failed(str(e) or type(e).__name__)
+            else:
+                stats.completed(latency)
+
+    async def generate(self, user_id):
+        inbox = self.telegram.inboxes[user_id]
+        self.send_text(user_id, "/menu")
+        menu = await self.expect(inbox, "Menu")
+        for data in ["Taqdimot", "language_English", f"template_{random.choice(TEMPLATES)}", "type_Ilmiy",
+                     f"slide_count_{random.choice(COUNTS)}"]:
+            await asyncio.sleep(random.expovariate(1 / self.think_time))
+            self.click(user_id, menu, data)
+            menu = await self.expect(inbox)
+
+        started = time.monotonic()
+        self.send_text(user_id, random.choice(TOPICS))
+        while True:
+            method, message = await asyncio.wait_for(inbox.get(), self.job_timeout)
+            if method == "sendDocument":
+                return time.monotonic() - started
+            if "⌛" not in message["text"]:
+                raise FlowError(f"job failed: {message['text'][:60]}")
+
+    async def expect(self, inbox, text=None):
+        method, message = await asyncio.wait_for(inbox.get(), self.reply_timeout)
+        if text is not None and text not in message["text"]:
+            raise FlowError(f"unexpected reply: {message['text'][:60]}")
+        return message
+
+    def send_text(self, user_id, text):
+        message = self.telegram.message(user_id, text)
+        message["from"] = self.user(user_id)
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        self.telegram.push_update({"message": message})
+
+    def click(self, user_id, message, data):
+        buttons = [button["callback_data"] for row in message.get("reply_markup", {}).get("inline_keyboard", [])
+                   for button in row]
+        if data not in buttons:
+            raise FlowError(f"no {data!r} button in {message['text'][:40]!r}")
+        self.telegram.push_update({"callback_query": {
+            "id": str(random.randrange(10 ** 9)),
+            "from": self.user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": message,
+        }})
+
+    @staticmethod
+    def user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": "Virtual", "username": f"vu{user_id}"}